@@ -3,9 +3,11 @@ sys.path.extend(["/home/nadzya/Apps/log-anomaly-detector/"])
 
 """Log aggregator"""
 from aggregator.log_aggregator import Aggregator
+from aggregator.distributed import DistributedAggregator
 from anomaly_detector.config import Configuration
 
 import os
+import socket
 import click
 import yaml
 
@@ -31,16 +33,51 @@ def get_configs(path_to_yaml_file):
                 configs.append(Configuration(config_dict=config_data))
     return configs
 
+def get_lease_storage(config, sqlite_path=None):
+    """Return lease storage in the target database of the configuration"""
+    if config.STORAGE_DATASINK not in ('mg', 'mysql'):
+        # The work units are finished only when all their logs are tagged
+        raise click.UsageError("Distributed mode requires mg or mysql STORAGE_DATASINK")
+    if sqlite_path:
+        from aggregator.storage.lease_storage import SQLiteLeaseStorage
+        return SQLiteLeaseStorage(sqlite_path)
+    if config.STORAGE_DATASINK == 'mg':
+        from aggregator.storage.mongodb_storage import MongoDBLeaseStorage
+        return MongoDBLeaseStorage(config)
+    from aggregator.storage.mysql_storage import MySQLLeaseStorage
+    return MySQLLeaseStorage(config)
+
 @click.group()
 def cli():
     return
 
 @cli.command("run")
 @click.option("--config-yaml", default="aggregator.yaml", help="configuration file used to configure service")
-def run(config_yaml):
+@click.option("--pushdown", is_flag=True, default=False,
+              help="group exact duplicate logs in the database before aggregation")
+@click.option("--distributed", is_flag=True, default=False,
+              help="share the work with other aggregator instances through leases in the target database")
+@click.option("--node-id", default="%s-%d" % (socket.gethostname(), os.getpid()),
+              help="unique name of this aggregator instance")
+@click.option("--slice-length", default=3600, help="length of a distributed work unit in seconds")
+@click.option("--slice-lag", default=300,
+              help="seconds to wait after the end of a time slice for the logs which are ingested late")
+@click.option("--timezone", type=click.Choice(["local", "utc"]), default="local",
+              help="time zone of MySQL DATETIME columns in distributed mode (MongoDB is always UTC)")
+@click.option("--lease-ttl", default=300, help="seconds after which a lease of a dead instance is taken over")
+@click.option("--lease-sqlite", default=None,
+              help="keep leases in this SQLite file instead of the target database (one machine only)")
+def run(config_yaml, pushdown, distributed, node_id, slice_length, slice_lag, timezone, lease_ttl,
+        lease_sqlite):
     configs = get_configs(config_yaml)
+    if distributed:
+        aggr = DistributedAggregator(configs, get_lease_storage(configs[0], lease_sqlite), node_id,
+                                     slice_length=slice_length, slice_lag=slice_lag, lease_ttl=lease_ttl,
+                                     pushdown=pushdown, timezone=timezone)
+        aggr.run()
+        return
     for config in configs:
-        aggr = Aggregator(config)
+        aggr = Aggregator(config, pushdown=pushdown)
         aggr.aggregator()
 
 if __name__ == "__main__":
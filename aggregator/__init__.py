@@ -1,6 +1,18 @@
 """Log Aggrageator package"""
-from aggregator.datacleaner import DataCleaner
-from aggregator.log_aggregator import Aggregator
+import importlib
+
+# Submodules are imported lazily on the first attribute access,
+# so that "import aggregator" doesn't load pandas, sklearn, gensim
+# and the database drivers
+_LAZY_ATTRIBUTES = {"DataCleaner": "aggregator.datacleaner",
+                    "Aggregator": "aggregator.log_aggregator",
+                    }
 
 __all__ = ["DataCleaner",
-           "Aggragator"]
+           "Aggregator"]
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
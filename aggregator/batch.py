@@ -0,0 +1,115 @@
+"""Columnar batch of aggregated messages"""
+import datetime
+import numpy as np
+
+
+class AggregatedBatch:
+    """Aggregated messages stored column by column in numpy arrays
+
+    The ids of the original messages of all aggregated messages are
+    concatenated into one array, the ids of the i-th aggregated message
+    are original_msgs_ids[offsets[i]:offsets[i + 1]]
+
+    In distributed mode every aggregated message also stores the key of
+    its work unit, so that a retry can find the results of a failed attempt.
+    """
+
+    # Names of the columns in the target collection or table
+    FIELDS = ("message", "total_logs", "average_datetime", "hostname",
+              "average_anomaly_score", "was_added_at")
+
+    def __init__(self, ids, messages, total_logs, average_datetimes, hostnames,
+                 average_anomaly_scores, original_msgs_ids, offsets, was_added_at=None, work_unit=None):
+        self.ids = np.asarray(ids)
+        self.messages = np.asarray(messages, dtype=object)
+        self.total_logs = np.asarray(total_logs, dtype=np.int64)
+        self.average_datetimes = np.asarray(average_datetimes, dtype="datetime64[us]").astype("datetime64[s]")
+        self.hostnames = np.asarray(hostnames, dtype=object)
+        self.average_anomaly_scores = np.asarray(average_anomaly_scores, dtype=np.float64)
+        self.original_msgs_ids = np.asarray(original_msgs_ids)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if was_added_at is None:
+            was_added_at = datetime.datetime.now().replace(microsecond=0)
+        self.was_added_at = was_added_at
+        self.work_unit = work_unit
+
+    def __len__(self):
+        return len(self.messages)
+
+    def get_original_msgs_ids(self, i):
+        """Return the array of original messages ids of the i-th aggregated message"""
+        return self.original_msgs_ids[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def columns(self):
+        """Names of the stored columns except the id: FIELDS and work_unit if it is set"""
+        if self.work_unit is None:
+            return self.FIELDS
+        return self.FIELDS + ("work_unit",)
+
+    def rows(self):
+        """Return list of tuples (id, *columns) with driver-native values"""
+        columns = [self.ids.tolist(),
+                   self.messages.tolist(),
+                   self.total_logs.tolist(),
+                   self.average_datetimes.tolist(),
+                   self.hostnames.tolist(),
+                   self.average_anomaly_scores.tolist(),
+                   [self.was_added_at] * len(self)]
+        if self.work_unit is not None:
+            columns.append([self.work_unit] * len(self))
+        return list(zip(*columns))
+
+    def to_dicts(self, id_field="_id"):
+        """Return list of dicts with the aggregated messages
+
+        :param id_field: the name of the id field in the target storage,
+                         None to leave ids out
+        """
+        if id_field is None:
+            return [dict(zip(self.columns, row[1:])) for row in self.rows()]
+        keys = (id_field,) + self.columns
+        return [dict(zip(keys, row)) for row in self.rows()]
+
+
+class AggregatedBatchBuilder:
+    """Collect aggregated messages one by one and build AggregatedBatch"""
+
+    def __init__(self):
+        self.messages = []
+        self.total_logs = []
+        self.average_datetimes = []
+        self.hostnames = []
+        self.average_anomaly_scores = []
+        self.original_msgs_ids = []
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, message, total_logs, average_datetime, hostname,
+               average_anomaly_score, original_msgs_ids):
+        """Add aggregated message
+
+        :param original_msgs_ids: array of the original messages ids
+        """
+        self.messages.append(message)
+        self.total_logs.append(total_logs)
+        self.average_datetimes.append(average_datetime)
+        self.hostnames.append(hostname)
+        self.average_anomaly_scores.append(average_anomaly_score)
+        self.original_msgs_ids.append(original_msgs_ids)
+
+    def build(self, ids):
+        """Return AggregatedBatch with all the collected messages
+
+        :param ids: ids of the aggregated messages in the target storage
+        """
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in self.original_msgs_ids], out=offsets[1:])
+        if self.original_msgs_ids:
+            original_msgs_ids = np.concatenate(self.original_msgs_ids)
+        else:
+            original_msgs_ids = np.array([], dtype=np.int64)
+        return AggregatedBatch(ids, self.messages, self.total_logs, self.average_datetimes,
+                               self.hostnames, self.average_anomaly_scores,
+                               original_msgs_ids, offsets)
@@ -1,6 +1,4 @@
 import re
-import pandas as pd
-import datetime
 
 class DataCleaner:
     """Data cleaning utility functions."""
@@ -0,0 +1,246 @@
+"""Distributed aggregation
+
+The logs are split into work units (input table x time slice x hostname).
+Every aggregator instance walks through the same list of work units and
+processes only the ones whose lease it manages to claim, so any number of
+instances can share the load without processing the same logs twice.
+
+If LOGSOURCE_HOSTNAME of the configuration is 'localhost' (all the hosts
+of the table), each time slice is split into one work unit per hostname
+which has untagged logs in the slice.
+"""
+import copy
+import datetime
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from aggregator.storage.lease_storage import LeaseLostError
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class WorkUnit(namedtuple("WorkUnit", ["table", "hostname", "start", "end"])):
+    """Logs of one input table and hostname within [start, end) time slice
+
+    start and end are naive datetimes in the clock of the input storage
+    """
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        """Lease key of the work unit, the same on every instance"""
+        return "%s:%s:%s-%s" % (self.table, self.hostname, self.start.isoformat(), self.end.isoformat())
+
+    @property
+    def time_range(self):
+        """Length of the slice in seconds"""
+        return (self.end - self.start).total_seconds()
+
+
+def get_time_slices(slice_length, first_start, last_end, utc):
+    """Return the list of (start, end) naive datetimes, oldest first
+
+    :param first_start: unix time of the first slice start
+    :param last_end: unix time of the last slice end
+    :param utc: use UTC instead of the local time zone
+
+    Local time goes back on DST change, so the slice boundaries are
+    converted to the latest local time seen so far: the slices never
+    overlap and the slices which fall into the repeated hour are dropped.
+    The boundaries are tracked from one day before first_start, so that
+    every run of every instance gets the same slices.
+    """
+    to_datetime = datetime.datetime.utcfromtimestamp if utc else datetime.datetime.fromtimestamp
+    slices = []
+    latest = None
+    for start in range(first_start - 86400, last_end, slice_length):
+        end = to_datetime(start + slice_length)
+        begin = latest if latest is not None and latest > to_datetime(start) else to_datetime(start)
+        if latest is None or end > latest:
+            latest = end
+        if start >= first_start and end > begin:
+            slices.append((begin, end))
+    return slices
+
+
+def get_work_units(config, slice_length, now=None, slice_lag=0, timezone="local", hostnames=None):
+    """Return work units of the last AGGR_TIME_SPAN seconds, newest first
+
+    Slices are aligned to multiples of slice_length seconds since the epoch,
+    so that all instances split the time in the same way. The slices which
+    ended less than slice_lag seconds ago are left for the later runs,
+    so that the logs which are ingested late are not missed.
+
+    MongoDB stores datetimes in UTC, so its slices are always in UTC.
+    MySQL DATETIME has no time zone, its slices are in the given timezone
+    ('local' or 'utc') which must be the one the logs are written in.
+
+    :param config: configuration of one input table
+    :param slice_length: length of the time slices in seconds
+    :param now: current unix time
+    :param slice_lag: seconds to wait after the end of a slice
+    :param timezone: 'local' or 'utc', the clock of MySQL input table
+    :param hostnames: function which returns the list of hostnames of one
+                      slice by its start and end, by default every slice
+                      has one unit with LOGSOURCE_HOSTNAME of the config
+    """
+    if now is None:
+        now = time.time()
+    if config.STORAGE_DATASOURCE == 'mg':
+        table = config.MG_INPUT_COL
+        utc = True
+    else:
+        table = config.MYSQL_INPUT_TABLE
+        utc = timezone == "utc"
+    last_end = int((now - slice_lag) // slice_length) * slice_length
+    first_start = int((now - config.AGGR_TIME_SPAN) // slice_length) * slice_length
+    if hostnames is None:
+        def hostnames(start, end):
+            return [config.LOGSOURCE_HOSTNAME]
+    return [WorkUnit(table, hostname, start, end)
+            for start, end in reversed(get_time_slices(slice_length, first_start, last_end, utc))
+            for hostname in sorted(hostnames(start, end))]
+
+
+class Lease:
+    """Context manager which renews the claimed lease in the background
+
+    The lease is renewed every ttl / 3 seconds. If it was taken over by
+    another instance (e.g. this one was stalled for longer than ttl),
+    or it couldn't be renewed within ttl, the lost flag is set.
+    """
+
+    def __init__(self, storage, key, owner, ttl):
+        self.storage = storage
+        self.key = key
+        self.owner = owner
+        self.ttl = ttl
+        self.lost = threading.Event()
+        self._stopped = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+
+    def _renew(self):
+        renewed_at = time.time()
+        while not self._stopped.wait(self.ttl / 3):
+            try:
+                renewed = self.storage.renew(self.key, self.owner, self.ttl)
+            except Exception:
+                _LOGGER.exception("Failed to renew lease %s", self.key)
+                if time.time() - renewed_at >= self.ttl:
+                    self.lost.set()
+                    return
+                continue
+            if not renewed:
+                _LOGGER.warning("Lease %s was taken over by another aggregator", self.key)
+                self.lost.set()
+                return
+            renewed_at = time.time()
+
+    def check(self):
+        """Raise LeaseLostError unless the lease still belongs to the owner
+
+        The lease is renewed synchronously, so that the results are written
+        only while no other instance can take the work unit over.
+        """
+        if not self.lost.is_set():
+            try:
+                if self.storage.renew(self.key, self.owner, self.ttl):
+                    return
+            except Exception:
+                _LOGGER.exception("Failed to renew lease %s", self.key)
+            self.lost.set()
+        raise LeaseLostError("Lease %s was lost" % self.key)
+
+    def __enter__(self):
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._heartbeat.join()
+
+
+class DistributedAggregator:
+    """Aggregate the work units whose leases were claimed by this instance"""
+
+    def __init__(self, configs, lease_storage, node_id, slice_length=3600, slice_lag=300,
+                 lease_ttl=300, pushdown=False, timezone="local"):
+        """Initialize distributed aggregator
+
+        :param configs: configurations of the input tables
+        :param lease_storage: LeaseStorage shared by all the instances
+        :param node_id: unique name of this instance
+        :param slice_length: length of the time slices in seconds
+        :param slice_lag: seconds to wait after the end of a slice before it is aggregated
+        :param lease_ttl: seconds after which the lease of a dead instance can be taken over
+        :param timezone: 'local' or 'utc', the clock of MySQL input tables
+        """
+        self.configs = configs
+        self.lease_storage = lease_storage
+        self.node_id = node_id
+        self.slice_length = slice_length
+        self.slice_lag = slice_lag
+        self.lease_ttl = lease_ttl
+        self.pushdown = pushdown
+        self.timezone = timezone
+
+    def process(self, config, unit, lease):
+        """Aggregate logs of one work unit
+
+        The results of the previous unfinished attempts are deleted first,
+        then only the logs which are not tagged yet are aggregated.
+        Every pass reads at most AGGR_MAX_ENTRIES logs, the passes are
+        repeated until the slice has no untagged logs left.
+        """
+        from aggregator.log_aggregator import Aggregator
+        config = copy.copy(config)
+        config.LOGSOURCE_HOSTNAME = unit.hostname
+        aggr = Aggregator(config, pushdown=self.pushdown, time_range=unit.time_range,
+                          end=unit.end, lease=lease)
+        aggr.reset_work_unit()
+        while True:
+            batch = aggr.aggregator()
+            if batch is None or batch.total_logs.sum() < config.AGGR_MAX_ENTRIES:
+                return
+
+    def get_hostnames(self, config, start, end):
+        """Return the hostnames which have untagged logs within [start, end)
+
+        Only LOGSOURCE_HOSTNAME is returned unless it is 'localhost'
+        """
+        if config.LOGSOURCE_HOSTNAME != 'localhost':
+            return [config.LOGSOURCE_HOSTNAME]
+        from aggregator.log_aggregator import Aggregator
+        return Aggregator(config).get_hostnames(start, end)
+
+    def run(self, now=None):
+        """Process all the work units which are not claimed by other instances
+
+        Return the list of work units processed by this instance
+        """
+        processed = []
+        for config in self.configs:
+            units = get_work_units(config, self.slice_length, now, self.slice_lag, self.timezone,
+                                   hostnames=lambda start, end: self.get_hostnames(config, start, end))
+            for unit in units:
+                if not self.lease_storage.claim(unit.key, self.node_id, self.lease_ttl):
+                    continue
+                _LOGGER.info("%s claimed %s", self.node_id, unit.key)
+                with Lease(self.lease_storage, unit.key, self.node_id, self.lease_ttl) as lease:
+                    try:
+                        self.process(config, unit, lease)
+                    except LeaseLostError:
+                        _LOGGER.warning("%s lost the lease of %s before storing results", self.node_id, unit.key)
+                        continue
+                    except Exception:
+                        _LOGGER.exception("Failed to aggregate %s", unit.key)
+                        self.lease_storage.release(unit.key, self.node_id)
+                        continue
+                if lease.lost.is_set() or not self.lease_storage.complete(unit.key, self.node_id):
+                    _LOGGER.warning("%s lost the lease of %s before completion", self.node_id, unit.key)
+                    continue
+                processed.append(unit)
+        return processed
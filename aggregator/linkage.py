@@ -0,0 +1,60 @@
+"""Compact linkage between aggregated events and their original messages"""
+import numpy as np
+
+# Maximum number of ids or id ranges that are sent to the database in one statement
+LINK_CHUNK_SIZE = 10000
+
+
+def id_ranges(ids):
+    """Collapse integer ids into the sorted list of inclusive (first, last) ranges
+
+    :param ids: array-like of integer ids (e.g. MySQL logids)
+
+    Example: [7, 3, 4, 5, 9, 8] -> [(3, 5), (7, 9)]
+    """
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    if not ids.size:
+        return []
+    breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+    starts = ids[np.concatenate(([0], breaks))]
+    ends = ids[np.concatenate((breaks - 1, [ids.size - 1]))]
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def chunked(items, size=LINK_CHUNK_SIZE):
+    """Split a sequence into consecutive slices of at most size elements"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def ranges_update_sql(table, column, links, untagged_only=False):
+    """Return one UPDATE statement which tags all the ranges of logids
+
+    The ranges are joined as a derived table, so MySQL looks up every range
+    in the logid index instead of testing each row against all the ranges.
+
+    :param table: the table with the original messages
+    :param column: the column which is set to the aggregated message id
+    :param links: list of (aggregated message id, first logid, last logid)
+    :param untagged_only: don't overwrite the tags which are already set
+    """
+    return ("UPDATE %s AS originals JOIN (%s) AS links "
+            "ON originals.logid BETWEEN links.first_logid AND links.last_logid "
+            "SET originals.%s = links.aggr_msg_id%s") % (
+        table,
+        " UNION ALL ".join(
+            "SELECT %d AS aggr_msg_id, %d AS first_logid, %d AS last_logid" % link if i == 0
+            else "SELECT %d, %d, %d" % link
+            for i, link in enumerate(links)),
+        column,
+        " WHERE originals.%s IS NULL" % column if untagged_only else ""
+    )
+
+
+def ranges_condition(column, ranges):
+    """Return SQL condition which matches the values of column within the ranges
+
+    :param ranges: list of inclusive (first, last) ranges, see id_ranges
+    """
+    return "(%s)" % " OR ".join("%s BETWEEN %d AND %d" % (column, first, last)
+                                for first, last in ranges)
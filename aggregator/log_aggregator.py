@@ -1,76 +1,128 @@
 import datetime
 import logging
-import pandas as pd
 import numpy as np
-from sklearn.cluster import DBSCAN
 from pprint import pprint
-from bson.objectid import ObjectId
 
-from anomaly_detector.storage.storage_attribute import MGStorageAttribute, MySQLStorageAttribute
-from aggregator.storage.mongodb_storage import MongoDBDataStorageSource, MongoDBDataSink
-from aggregator.storage.mysql_storage import MySQLDataStorageSource, MySQLDataSink, MySQLStorage
-from aggregator.datacleaner import DataCleaner
-from aggregator.models.word2vec import W2VModel
+from aggregator.batch import AggregatedBatchBuilder
+
+# Storage backends (pymongo, bson, mysql.connector) and ML libraries
+# (pandas, sklearn, gensim) are imported only when they are first used,
+# so that a config which uses one backend doesn't pay for the others
 
 _LOGGER = logging.getLogger(__name__)
 
 class Aggregator:
 
-    def __init__(self, config):
+    def __init__(self, config, pushdown=False, time_range=None, end=None, lease=None):
         self.config = config
+        self.pushdown = pushdown
+        # By default the logs of the last AGGR_TIME_SPAN seconds are aggregated
+        self.time_range = config.AGGR_TIME_SPAN if time_range is None else time_range
+        self.end = end
+        # Lease of the work unit in distributed mode
+        self.lease = lease
         self.source_storage_catalog = {'mg': self._get_logs_from_mg,
                                        'mysql': self._get_logs_from_mysql,
                                        }
         self.sink_storage_catalog = {'mg': self._write_logs_to_mg,
-                                     "stdout": pprint,
+                                     "stdout": self._write_logs_to_stdout,
                                      'mysql': self._write_logs_to_mysql,
                                      }
+        self.hostnames_storage_catalog = {'mg': self._get_hostnames_from_mg,
+                                          'mysql': self._get_hostnames_from_mysql,
+                                          }
+        self.reset_storage_catalog = {'mg': self._reset_work_unit_in_mg,
+                                      'mysql': self._reset_work_unit_in_mysql,
+                                      }
 
     def _get_logs_from_mg(self):
         """Retrieve data from MongoDB"""
+        from anomaly_detector.storage.storage_attribute import MGStorageAttribute
+        from aggregator.storage.mongodb_storage import MongoDBDataStorageSource
         mg = MongoDBDataStorageSource(self.config)
-        mg_attr = MGStorageAttribute(self.config.AGGR_TIME_SPAN,
+        mg_attr = MGStorageAttribute(self.time_range,
                                      self.config.AGGR_MAX_ENTRIES)
-        return mg.retrieve(mg_attr)
+        return mg.retrieve(mg_attr, pushdown=self.pushdown, end=self.end,
+                           untagged_only=self.lease is not None)
+
+    def _get_hostnames_from_mg(self, start, end):
+        """Retrieve hostnames of untagged logs from MongoDB"""
+        from aggregator.storage.mongodb_storage import MongoDBDataStorageSource
+        mg = MongoDBDataStorageSource(self.config)
+        return mg.get_hostnames(start, end, untagged_only=True)
+
+    def _write_logs_to_stdout(self, data, original_messages):
+        """Print data to stdout
+
+        :param data: AggregatedBatch which should be printed
+        """
+        pprint(data.to_dicts(id_field=None))
 
     def _write_logs_to_mg(self, data, original_messages):
         """Write data to MongoDB
 
-        :param data: data in json format which should be pushed to DB
+        :param data: AggregatedBatch which should be pushed to DB
         """
-        mg = MongoDataSink(self.config)
-        mg.store_results(data, original_messages)
+        from aggregator.storage.mongodb_storage import MongoDBDataSink
+        mg = MongoDBDataSink(self.config)
+        mg.store_results(data, original_messages, lease=self.lease)
 
     def _get_logs_from_mysql(self):
         """Retrieve data from MySQL"""
+        from anomaly_detector.storage.storage_attribute import MySQLStorageAttribute
+        from aggregator.storage.mysql_storage import MySQLDataStorageSource
         mysql = MySQLDataStorageSource(self.config)
-        mysql_attr = MySQLStorageAttribute(self.config.AGGR_TIME_SPAN,
+        mysql_attr = MySQLStorageAttribute(self.time_range,
                                            self.config.AGGR_MAX_ENTRIES)
-        return mysql.retrieve(mysql_attr)
+        return mysql.retrieve(mysql_attr, pushdown=self.pushdown, end=self.end,
+                              untagged_only=self.lease is not None)
+
+    def _get_hostnames_from_mysql(self, start, end):
+        """Retrieve hostnames of untagged logs from MySQL"""
+        from aggregator.storage.mysql_storage import MySQLDataStorageSource
+        mysql = MySQLDataStorageSource(self.config)
+        return mysql.get_hostnames(start, end, untagged_only=True)
 
     def _write_logs_to_mysql(self, data, original_messages):
-        """Write data to MongoDB
+        """Write data to MySQL
 
-        :param data: data in json format which should be pushed to DB
+        :param data: AggregatedBatch which should be pushed to DB
         """
+        from aggregator.storage.mysql_storage import MySQLDataSink
         mg = MySQLDataSink(self.config)
-        mg.store_results(data, original_messages)
+        mg.store_results(data, original_messages, lease=self.lease)
+
+    def _reset_work_unit_in_mg(self, key, start, end):
+        """Delete results of the work unit from MongoDB"""
+        from aggregator.storage.mongodb_storage import MongoDBDataSink
+        mg = MongoDBDataSink(self.config)
+        mg.reset_work_unit(key, start, end)
 
+    def _reset_work_unit_in_mysql(self, key, start, end):
+        """Delete results of the work unit from MySQL"""
+        from aggregator.storage.mysql_storage import MySQLDataSink
+        mysql = MySQLDataSink(self.config)
+        mysql.reset_work_unit(key, start, end)
 
-    def _get_last_aggr_msg_id(self):
-        mysql = MySQLStorage(self.config, is_input=False)
-        sql = 'SELECT MAX(aggr_msg_id) FROM %s' % self.config.MYSQL_TARGET_TABLE
-        cursor = mysql.db.cursor()
-        data = cursor.execute(sql)
-        if data:
-            return data[0]
-        return 0
+    def get_hostnames(self, start, end):
+        """Return the hostnames which have untagged logs within [start, end)"""
+        return self.hostnames_storage_catalog[self.config.STORAGE_DATASOURCE](start, end)
 
+    def reset_work_unit(self):
+        """Delete results of the previous unfinished attempts of the work unit
 
-    def _get_mean_time(self, time_list):
+        The aggregated messages stored under the key of the lease are deleted
+        and their original messages are untagged, so they are aggregated again
+        """
+        self.lease.check()
+        start = self.end - datetime.timedelta(seconds=self.time_range)
+        self.reset_storage_catalog[self.config.STORAGE_DATASINK](self.lease.key, start, self.end)
+
+    def _get_mean_time(self, time_list, weights=None):
         """Return mean time in ISO format
 
         :param timelist: the list of timestamps in absolute format
+        :param weights: the number of original logs behind each timestamp
         """
         if not isinstance(time_list, list):
             return time_list
@@ -78,25 +130,27 @@ class Aggregator:
             tmp = []
             for x in time_list:
                 tmp.append(x.timestamp())
-            mean = float(np.mean(tmp))
+            mean = float(np.average(tmp, weights=weights))
             return datetime.datetime.fromtimestamp(mean)
-        mean = int(np.mean(time_list))
+        mean = int(np.average(time_list, weights=weights))
         return datetime.datetime.fromtimestamp(mean / 1e3) - datetime.timedelta(hours=3)
 
 
-    def get_clusters(self, vectors):
+    def get_clusters(self, vectors, weights=None):
         """Clusterize logs and return clusters array
 
         :params vectors: list of vectors, which represent log messages
+        :params weights: the number of original logs behind each vector
         """
+        from sklearn.cluster import DBSCAN
         dbscan = DBSCAN(eps=self.config.AGGR_EPS,
                         min_samples=self.config.AGGR_MIN_SAMPLES)
-        clusters = dbscan.fit_predict(vectors)
+        clusters = dbscan.fit_predict(vectors, sample_weight=weights)
         _LOGGER.info("%s clusters were detected with DBSCAN algorithm", np.unique(clusters))
         return clusters
 
     def aggregate_logs(self, df, logs_json, clusters):
-        """Return list of aggregated messages with aggregated parameters
+        """Return AggregatedBatch of aggregated messages with aggregated parameters
 
         :param df: dataframe of logs with "message" and "cluster" column
         :param logs_json: list of logs in json format, where all logs are python dicts with "message" key
@@ -105,67 +159,72 @@ class Aggregator:
 
         The number of rows in df, dicts in logs_json and integers in clusters must be the same
 
+        If the logs were pre-aggregated by the database (see pushdown), each log
+        also carries "total_logs" and "original_msgs_ids" of its exact duplicates
+
         Result example:
 
         <190>date=2021-12-01 * ** *** logid="0100026003" type="event" subtype="system" level="information" vd="root" **** tz="+0300" logdesc="DHCP statistics" ***** ****** ******* msg="DHCP statistics"
         ... and the list of original messages
 
         """
-        aggregated = []
-        logs_json_with_relation = logs_json.copy()
-        mysql_id_incr = 1
-        last_aggr_msg_id = self._get_last_aggr_msg_id()
+        aggregated = AggregatedBatchBuilder()
+        if 'mg' in (self.config.STORAGE_DATASOURCE, self.config.STORAGE_DATASINK):
+            from bson.objectid import ObjectId
         for cluster in np.unique(clusters):
             logs = []
             messages = []
             timestamps = []
             hostnames = []
             anomaly_scores = []
+            weights = []
             original_msgs_ids = []
+            ids_numbers = []
             for i in list(df.loc[df['cluster'] == cluster].index):
-                if self.config.STORAGE_DATASINK == 'mg':
+                ids_before = len(original_msgs_ids)
+                # The format of the logs depends on where they were read from
+                if self.config.STORAGE_DATASOURCE == 'mg':
                     logs.append({"anomaly_score": logs_json[i]["anomaly_score"],
                                  "hostname": logs_json[i][self.config.HOSTNAME_INDEX],
                                  "message": logs_json[i][self.config.MESSAGE_INDEX],
                                  "timestamp": self._get_mean_time(logs_json[i][self.config.DATETIME_INDEX]["$date"])
                                  })
-                    timestamps.append([logs_json[i][self.config.DATETIME_INDEX]["$date"]])
-                    original_msgs_ids.append(ObjectId(logs_json[i]["_id"]["$oid"]))
-                elif self.config.STORAGE_DATASINK == 'mysql':
+                    timestamps.append(logs_json[i][self.config.DATETIME_INDEX]["$date"])
+                    if "original_msgs_ids" in logs_json[i]:
+                        original_msgs_ids.extend(ObjectId(x["$oid"]) for x in logs_json[i]["original_msgs_ids"])
+                    else:
+                        original_msgs_ids.append(ObjectId(logs_json[i]["_id"]["$oid"]))
+                elif self.config.STORAGE_DATASOURCE == 'mysql':
                     logs.append({"anomaly_score": logs_json[i]["anomaly_score"],
                                  "hostname": logs_json[i][self.config.HOSTNAME_INDEX],
                                  "message": logs_json[i][self.config.MESSAGE_INDEX],
                                  "timestamp": self._get_mean_time(logs_json[i][self.config.DATETIME_INDEX])
                                  })
                     timestamps.append(logs_json[i][self.config.DATETIME_INDEX])
-                    original_msgs_ids.append(logs_json[i]["logid"])
+                    original_msgs_ids.extend(logs_json[i].get("original_msgs_ids", [logs_json[i]["logid"]]))
 
                 messages.append(logs_json[i]["message"])
                 hostnames.append(logs_json[i][self.config.HOSTNAME_INDEX])
                 anomaly_scores.append(logs_json[i]["anomaly_score"])
+                weights.append(logs_json[i].get("total_logs", 1))
+                ids_numbers.append(len(original_msgs_ids) - ids_before)
 
+            # Keep the linkage to the original messages as one compact array per cluster
+            if self.config.STORAGE_DATASOURCE == 'mysql':
+                original_msgs_ids = np.array(original_msgs_ids, dtype=np.int64)
+            else:
+                original_msgs_ids = np.array(original_msgs_ids, dtype=object)
+            # Offsets of each log's original ids inside original_msgs_ids
+            offsets = np.concatenate(([0], np.cumsum(ids_numbers, dtype=np.int64)))
 
             if cluster == -1:
                 for i in range(len(messages)):
-                    if self.config.STORAGE_DATASINK == 'mg':
-                        aggregated.append((ObjectId(),
-                                           messages[i],
-                                           1,
-                                           self._get_mean_time(timestamps[i]),
-                                           hostnames[i],
-                                           anomaly_scores[i],
-                                           [original_msgs_ids[i]],
-                                           ))
-                    elif self.config.STORAGE_DATASINK == 'mysql':
-                        aggregated.append((last_aggr_msg_id + mysql_id_incr,
-                                           messages[i],
-                                           1,
-                                           self._get_mean_time(timestamps[i]),
-                                           hostnames[i],
-                                           anomaly_scores[i],
-                                           [original_msgs_ids[i]],
-                                           ))
-                        mysql_id_incr += 1
+                    aggregated.append(messages[i],
+                                      weights[i],
+                                      self._get_mean_time([timestamps[i]]),
+                                      hostnames[i],
+                                      anomaly_scores[i],
+                                      original_msgs_ids[offsets[i]:offsets[i + 1]])
             else:
                 splited_messages = [x.split() for x in messages]
                 splited_transpose = [list(row) for row in zip(*splited_messages)]
@@ -178,83 +237,55 @@ class Aggregator:
                     else:
                         result_string += "***" + " "
 
-                msg_num = len(messages)
+                msg_num = int(np.sum(weights))
 
                 cluster_df = df.loc[df['cluster'] == cluster]
-                mean_time = self._get_mean_time(timestamps)
-                anomaly_score = np.mean(anomaly_scores)
+                mean_time = self._get_mean_time(timestamps, weights)
+                anomaly_score = np.average(anomaly_scores, weights=weights)
                 # The most frequent hostname
-                hostname = max(set(hostnames), key = hostnames.count)
-
-                if self.config.STORAGE_DATASINK == 'mg':
-                    aggregated.append((ObjectId(),
-                                       result_string[:-1],
-                                       msg_num,
-                                       mean_time,
-                                       hostname,
-                                       anomaly_score,
-                                       original_msgs_ids))
-
-                elif self.config.STORAGE_DATASINK == 'mysql':
-                    aggregated.append((last_aggr_msg_id + mysql_id_incr,
-                                       result_string[:-1],
-                                       msg_num,
-                                       mean_time,
-                                       hostname,
-                                       anomaly_score,
-                                       original_msgs_ids))
-                    mysql_id_incr += 1
+                hostname_counts = {}
+                for host, weight in zip(hostnames, weights):
+                    hostname_counts[host] = hostname_counts.get(host, 0) + weight
+                hostname = max(hostname_counts, key=hostname_counts.get)
+
+                aggregated.append(result_string[:-1],
+                                  msg_num,
+                                  mean_time,
+                                  hostname,
+                                  anomaly_score,
+                                  original_msgs_ids)
 
                 _LOGGER.info("%s logs were aggregated into: %s", msg_num, result_string[:-1])
-        return aggregated
-
-    def aggregated_logs_to_json(self, aggregated_logs):
-        """Format each message to list of dict with mean timestamp
-
-        :param aggregated_logs: list of tuples (triplets) that represent message,
-                                total number of original messages in the cluster
-                                and the list of original messages
-        :param orig_df: logs dataframe with the original messages
-
-        Return list of dicts with the log messages, which should be pushes to database
-        """
 
-        result = []
-        for (_id, msg, total_num, mean_time,
-             hostname, anomaly_score, original_msgs_ids) in aggregated_logs:
-            data = {}
-            if self.config.STORAGE_DATASINK == 'mg':
-                data["_id"] = _id
-            if self.config.STORAGE_DATASINK == 'mysql':
-                data["aggr_msg_id"] = _id
-            data["message"] = msg
-            data["total_logs"] = total_num
-            data["average_datetime"] = "'" +  mean_time.strftime("%Y-%m-%d %H:%M:%S") + "'"
-            data["hostname"] = hostname
-            data["average_anomaly_score"] = anomaly_score
-            data["was_added_at"] = "'" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "'"
-            data["original_msgs_ids"] = original_msgs_ids
-            result.append(data)
-        return result
+        if self.config.STORAGE_DATASINK == 'mg':
+            ids = np.array([ObjectId() for _ in range(len(aggregated))], dtype=object)
+        else:
+            # MySQL sink shifts these ids after the last aggr_msg_id in the target table,
+            # stdout sink doesn't print them
+            ids = np.arange(1, len(aggregated) + 1, dtype=np.int64)
+        return aggregated.build(ids)
 
     def aggregator(self):
         """The main function for the aggregator"""
+        import pandas as pd
+        from aggregator.models.word2vec import W2VModel
         logs_df, logs_json = self.source_storage_catalog[self.config.STORAGE_DATASOURCE]()
         if logs_df.empty:
             _LOGGER.info("No logs were detected")
             return
         logs_list = list(logs_df[self.config.MESSAGE_INDEX])
+        weights = [x.get("total_logs", 1) for x in logs_json]
         w2v = W2VModel(self.config)
-        vectors = w2v.get_vectors(logs_list)
+        vectors = w2v.get_vectors(logs_list, weights if self.pushdown else None)
         logs_as_vectors = w2v.vectorized_logs_to_single_vectors(vectors)
-        clusters = self.get_clusters(logs_as_vectors)
+        clusters = self.get_clusters(logs_as_vectors, weights)
 
         # Normalized logs with cluster lables as DF
         df = pd.DataFrame(list(zip(logs_list, clusters)),
                           columns =['message', 'cluster'])
         # Aggregate logs
         aggr_logs = self.aggregate_logs(df, logs_json, clusters)
-        # Convert aggregated logs to json
-        aggr_json = self.aggregated_logs_to_json(aggr_logs)
-        self.sink_storage_catalog[self.config.STORAGE_DATASINK](aggr_json, logs_json)
-        return aggr_json
+        if self.lease is not None:
+            aggr_logs.work_unit = self.lease.key
+        self.sink_storage_catalog[self.config.STORAGE_DATASINK](aggr_logs, logs_json)
+        return aggr_logs
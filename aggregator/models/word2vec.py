@@ -1,6 +1,5 @@
 """Word2vec model"""
 import numpy as np
-from gensim.models import Word2Vec
 
 
 class W2VModel():
@@ -9,16 +8,32 @@ class W2VModel():
     def __init__(self, config=None):
         self.config = config
 
-    def create(self, logs):
+    def create(self, logs, weights=None):
         """Create word2vec model
 
         :param logs: list of normalized log messages (a log message is a list of words)
+        :param weights: the number of original logs behind each log message
         """
-        self.model = Word2Vec(sentences=list(logs), size=self.config.AGGR_VECTOR_LENGTH, window=self.config.AGGR_WINDOW)
+        from gensim.models import Word2Vec
+        if weights is None:
+            self.model = Word2Vec(sentences=list(logs), size=self.config.AGGR_VECTOR_LENGTH, window=self.config.AGGR_WINDOW)
+            return
+        # Pre-aggregated logs are counted with their duplicates, so that
+        # min_count keeps the same words as without pre-aggregation
+        freqs = {}
+        for log, weight in zip(logs, weights):
+            for word in log:
+                freqs[word] = freqs.get(word, 0) + weight
+        self.model = Word2Vec(size=self.config.AGGR_VECTOR_LENGTH, window=self.config.AGGR_WINDOW)
+        self.model.build_vocab_from_freq(freqs)
+        self.model.train(list(logs), total_examples=len(logs), epochs=self.model.epochs)
 
-    def get_vectors(self, logs):
-        """Return logs as list of vectorized words"""
-        self.create(logs)
+    def get_vectors(self, logs, weights=None):
+        """Return logs as list of vectorized words
+
+        :param weights: the number of original logs behind each log message
+        """
+        self.create(logs, weights)
         vectors = []
         for x in logs:
             temp = []
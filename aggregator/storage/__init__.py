@@ -1,5 +1,17 @@
 """Storage"""
-from aggregator.storage.mongodb_storage import MongoDBDataStorageSource, MongoDBDataSink
+import importlib
+
+# Storage backends are imported lazily, so that only the database driver
+# of the backend that is actually used gets loaded
+_LAZY_ATTRIBUTES = {"MongoDBDataStorageSource": "aggregator.storage.mongodb_storage",
+                    "MongoDBDataSink": "aggregator.storage.mongodb_storage",
+                    }
 
 __all__ = ['MongoDBDataStorageSource',
            'MongoDBDataSink']
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,156 @@
+"""Lease storage interface
+
+Leases are used to share work units between several aggregator instances.
+A lease belongs to one owner until it expires, the owner must renew it
+before the expiration time, otherwise any other instance can take it over.
+Expiration times are absolute unix timestamps, so the clocks of the
+instances must not differ by more than a fraction of the lease TTL.
+"""
+import abc
+import logging
+import sqlite3
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Name of the collection or table in the target database which stores leases
+LEASE_TABLE = "aggregator_leases"
+
+
+class LeaseLostError(Exception):
+    """The lease was taken over by another aggregator instance"""
+
+
+class LeaseStorage(abc.ABC):
+    """Lease storage backend."""
+
+    NAME = "lease"
+
+    def __init__(self):
+        # Leases are renewed from the heartbeat thread
+        self._lock = threading.Lock()
+
+    def claim(self, key, owner, ttl):
+        """Take the lease if it is free, expired or already belongs to owner
+
+        Return True if owner holds the lease for the next ttl seconds.
+        Completed leases are never claimed again.
+        """
+        with self._lock:
+            return self._claim(key, owner, time.time(), ttl)
+
+    def renew(self, key, owner, ttl):
+        """Extend the lease for the next ttl seconds
+
+        Return False if the lease was taken over by another owner.
+        """
+        with self._lock:
+            return self._renew(key, owner, time.time(), ttl)
+
+    def release(self, key, owner):
+        """Make the lease immediately available to other owners"""
+        with self._lock:
+            self._release(key, owner)
+
+    def complete(self, key, owner):
+        """Mark the work under the lease as done
+
+        Return False if the lease was taken over by another owner.
+        """
+        with self._lock:
+            return self._complete(key, owner)
+
+    @abc.abstractmethod
+    def _claim(self, key, owner, now, ttl):
+        """Take the lease, return True on success"""
+
+    @abc.abstractmethod
+    def _renew(self, key, owner, now, ttl):
+        """Extend the lease of owner, return True on success"""
+
+    @abc.abstractmethod
+    def _release(self, key, owner):
+        """Expire the lease of owner"""
+
+    @abc.abstractmethod
+    def _complete(self, key, owner):
+        """Mark the lease of owner as done, return True on success"""
+
+
+class SQLLeaseStorage(LeaseStorage):
+    """Lease storage in a table of SQL database.
+
+    Subclasses set self.db to DB-API connection in autocommit mode
+    and define the placeholder and "insert ignore" syntax of the database.
+    """
+
+    PLACEHOLDER = "%s"
+    INSERT_IGNORE = "INSERT IGNORE"
+
+    def _execute(self, sql, params=()):
+        """Execute sql statement and return the number of affected rows"""
+        cursor = self.db.cursor()
+        try:
+            cursor.execute(sql.replace("%s", self.PLACEHOLDER), params)
+            return cursor.rowcount
+        finally:
+            cursor.close()
+
+    def _create_table(self):
+        self._execute("CREATE TABLE IF NOT EXISTS %s ("
+                      "lease_key VARCHAR(255) NOT NULL PRIMARY KEY, "
+                      "owner VARCHAR(255) NOT NULL, "
+                      "expires_at DOUBLE NOT NULL, "
+                      "done SMALLINT NOT NULL DEFAULT 0)" % LEASE_TABLE)
+
+    def _claim(self, key, owner, now, ttl):
+        inserted = self._execute(
+            self.INSERT_IGNORE + " INTO " + LEASE_TABLE +
+            " (lease_key, owner, expires_at, done) VALUES (%s, %s, %s, 0)",
+            (key, owner, now + ttl))
+        if inserted == 1:
+            return True
+        taken = self._execute(
+            "UPDATE " + LEASE_TABLE + " SET owner = %s, expires_at = %s "
+            "WHERE lease_key = %s AND done = 0 AND (expires_at < %s OR owner = %s)",
+            (owner, now + ttl, key, now, owner))
+        return taken == 1
+
+    def _renew(self, key, owner, now, ttl):
+        renewed = self._execute(
+            "UPDATE " + LEASE_TABLE + " SET expires_at = %s "
+            "WHERE lease_key = %s AND owner = %s AND done = 0",
+            (now + ttl, key, owner))
+        return renewed == 1
+
+    def _release(self, key, owner):
+        self._execute(
+            "UPDATE " + LEASE_TABLE + " SET expires_at = 0 "
+            "WHERE lease_key = %s AND owner = %s AND done = 0",
+            (key, owner))
+
+    def _complete(self, key, owner):
+        completed = self._execute(
+            "UPDATE " + LEASE_TABLE + " SET done = 1 "
+            "WHERE lease_key = %s AND owner = %s AND done = 0",
+            (key, owner))
+        return completed == 1
+
+
+class SQLiteLeaseStorage(SQLLeaseStorage):
+    """Lease storage in SQLite database file.
+
+    It is a local stand-in for the target database: it lets several
+    aggregator processes on one machine share the work without MongoDB or MySQL.
+    """
+
+    NAME = "sqlite.lease"
+    PLACEHOLDER = "?"
+    INSERT_IGNORE = "INSERT OR IGNORE"
+
+    def __init__(self, path):
+        """Initialize SQLite lease storage backend."""
+        LeaseStorage.__init__(self)
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._create_table()
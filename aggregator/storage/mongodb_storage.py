@@ -1,7 +1,8 @@
 """MongoDB storage interface"""
 import datetime
 import pandas
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateMany
+from pymongo.errors import DuplicateKeyError
 import ssl
 import os
 import logging
@@ -10,12 +11,17 @@ from bson.objectid import ObjectId
 from pandas.io.json import json_normalize
 import json
 from aggregator.datacleaner import DataCleaner
+from aggregator.linkage import LINK_CHUNK_SIZE, chunked
+from aggregator.storage.lease_storage import LeaseLostError, LeaseStorage, LEASE_TABLE
 from anomaly_detector.storage.storage_attribute import MGStorageAttribute
 from anomaly_detector.storage.mongodb_storage import MongoDBStorage
 
 
 _LOGGER = logging.getLogger(__name__)
 
+# Maximum number of update requests in one bulk write
+LINK_REQUESTS_CHUNK_SIZE = 100
+
 
 class MongoDBDataStorageSource(DataCleaner, MongoDBStorage):
     """MongoDB data source implementation."""
@@ -27,11 +33,66 @@ class MongoDBDataStorageSource(DataCleaner, MongoDBStorage):
         self.config = config
         MongoDBStorage.__init__(self, config)
 
-    def retrieve(self, storage_attribute: MGStorageAttribute):
-        """Retrieve data from MongoDB."""
+    def _pushdown_pipeline(self, query, storage_attribute: MGStorageAttribute):
+        """Return aggregation pipeline which groups exact duplicates on the server
+
+        Each resulting document represents one distinct message per hostname
+        with the number of its duplicates, their time and anomaly score
+        statistics and the ids of the original messages. The ids are split
+        into chunks of LINK_CHUNK_SIZE, one document per chunk, so that the
+        resulting documents never exceed the BSON size limit.
+        """
+        return [
+            {"$match": query},
+            {"$sort": {self.config.DATETIME_INDEX: -1}},
+            {"$limit": storage_attribute.number_of_entries},
+            {"$group": {
+                "_id": {"message": "$" + self.config.MESSAGE_INDEX,
+                        "hostname": "$" + self.config.HOSTNAME_INDEX},
+                "average_time": {"$avg": {"$toLong": "$" + self.config.DATETIME_INDEX}},
+                "min_datetime": {"$min": "$" + self.config.DATETIME_INDEX},
+                "max_datetime": {"$max": "$" + self.config.DATETIME_INDEX},
+                "anomaly_score": {"$avg": "$anomaly_score"},
+                "original_msgs_ids": {"$push": "$_id"},
+            }},
+            {"$unwind": {"path": "$original_msgs_ids", "includeArrayIndex": "id_index"}},
+            {"$group": {
+                "_id": {"message": "$_id.message",
+                        "hostname": "$_id.hostname",
+                        "chunk": {"$floor": {"$divide": ["$id_index", LINK_CHUNK_SIZE]}}},
+                "first_id": {"$min": "$original_msgs_ids"},
+                "total_logs": {"$sum": 1},
+                "average_time": {"$first": "$average_time"},
+                "min_datetime": {"$first": "$min_datetime"},
+                "max_datetime": {"$first": "$max_datetime"},
+                "anomaly_score": {"$first": "$anomaly_score"},
+                "original_msgs_ids": {"$push": "$original_msgs_ids"},
+            }},
+            {"$project": {
+                "_id": "$first_id",
+                self.config.MESSAGE_INDEX: "$_id.message",
+                self.config.HOSTNAME_INDEX: "$_id.hostname",
+                self.config.DATETIME_INDEX: {"$toDate": {"$toLong": "$average_time"}},
+                "min_datetime": 1,
+                "max_datetime": 1,
+                "anomaly_score": 1,
+                "total_logs": 1,
+                "original_msgs_ids": 1,
+            }},
+        ]
+
+    def retrieve(self, storage_attribute: MGStorageAttribute, pushdown=False, end=None,
+                 untagged_only=False):
+        """Retrieve data from MongoDB.
+
+        :param pushdown: group exact duplicates with MongoDB aggregation pipeline
+                         and return one weighted log per distinct message
+        :param end: the end of the time range, the current time by default
+        :param untagged_only: skip the logs which are already aggregated
+        """
 
         mg_input_db = self.mg[self.config.MG_INPUT_DB]
-        now = datetime.datetime.now()
+        now = end or datetime.datetime.now()
 
         mg_data = mg_input_db[self.config.MG_INPUT_COL]
 
@@ -50,19 +111,37 @@ class MongoDBDataStorageSource(DataCleaner, MongoDBStorage):
                     '$lt': now
                 }
             }
+        if untagged_only:
+            query["aggregated_message_id"] = {"$exists": False}
 
-        mg_data = mg_data.find(query).sort(self.config.DATETIME_INDEX, -1).limit(storage_attribute.number_of_entries)
-        _LOGGER.info(
-            "Reading %d log entries in last %d seconds from %s",
-            mg_data.count(True),
-            storage_attribute.time_range,
-            self.config.MG_HOST,
-        )
+        if pushdown:
+            mg_data = list(mg_data.aggregate(self._pushdown_pipeline(query, storage_attribute),
+                                             allowDiskUse=True))
+            _LOGGER.info(
+                "Reading %d distinct log messages (%d log entries) in last %d seconds from %s",
+                len(mg_data),
+                sum(x["total_logs"] for x in mg_data),
+                storage_attribute.time_range,
+                self.config.MG_HOST,
+            )
+
+            self.mg.close()
+
+            if not mg_data:
+                return pandas.DataFrame(), mg_data
+        else:
+            mg_data = mg_data.find(query).sort(self.config.DATETIME_INDEX, -1).limit(storage_attribute.number_of_entries)
+            _LOGGER.info(
+                "Reading %d log entries in last %d seconds from %s",
+                mg_data.count(True),
+                storage_attribute.time_range,
+                self.config.MG_HOST,
+            )
 
-        self.mg.close()
+            self.mg.close()
 
-        if not mg_data.count():   # if it equials 0:
-            return pandas.DataFrame(), mg_data
+            if not mg_data.count():   # if it equials 0:
+                return pandas.DataFrame(), mg_data
 
         mg_data = dumps(mg_data, sort_keys=False)
         mg_data_normalized = pandas.DataFrame(pandas.json_normalize(json.loads(mg_data)))
@@ -71,6 +150,17 @@ class MongoDBDataStorageSource(DataCleaner, MongoDBStorage):
         self._preprocess(mg_data_normalized)
         return mg_data_normalized, json.loads(mg_data)
 
+    def get_hostnames(self, start, end, untagged_only=False):
+        """Return the hostnames which have logs within [start, end)
+
+        :param untagged_only: skip the logs which are already aggregated
+        """
+        query = {self.config.DATETIME_INDEX: {'$gte': start, '$lt': end}}
+        if untagged_only:
+            query["aggregated_message_id"] = {"$exists": False}
+        mg_data = self.mg[self.config.MG_INPUT_DB][self.config.MG_INPUT_COL]
+        return [x for x in mg_data.distinct(self.config.HOSTNAME_INDEX, query) if x is not None]
+
 
 class MongoDBDataSink(DataCleaner, MongoDBStorage):
     """MongoDB data sink implementation."""
@@ -82,24 +172,122 @@ class MongoDBDataSink(DataCleaner, MongoDBStorage):
         self.config = config
         MongoDBStorage.__init__(self, config)
 
-    def store_results(self, data, original_messages):
-        """Store results back to MongoDB"""
+    def store_results(self, data, original_messages, lease=None):
+        """Store results back to MongoDB
+
+        :param data: AggregatedBatch with the aggregated messages
+        :param lease: Lease of the work unit in distributed mode, the results
+                      are stored only while it belongs to this instance
+
+        The aggregated messages are inserted before the original messages
+        are tagged, so a tag never points to a message which wasn't stored.
+        In distributed mode the aggregated messages carry the key of the
+        work unit and only untagged messages are tagged: if tagging fails,
+        the retry deletes the messages of the work unit with reset_work_unit
+        and starts over.
+        """
         mg_input_db = self.mg[self.config.MG_INPUT_DB]
         mg_input_col = mg_input_db[self.config.MG_INPUT_COL]
         mg_target_db = self.mg[self.config.MG_TARGET_DB]
         mg_target_col = mg_target_db[self.config.MG_TARGET_COL]
         _LOGGER.info("Inderting data to MongoDB.")
-        for aggr_data in data:
-            to_insert = aggr_data.copy()
-            del to_insert["original_msgs_ids"]
-            for _id in aggr_data["original_msgs_ids"]:
-                mg_input_col.update_one(
-                    {
-                        "_id": _id
-                     },
+        if not len(data):
+            return
+        link_requests = []
+        for i, aggr_msg_id in enumerate(data.ids.tolist()):
+            for ids in chunked(data.get_original_msgs_ids(i)):
+                link_filter = {"_id": {"$in": ids.tolist()}}
+                if lease is not None:
+                    link_filter["aggregated_message_id"] = {"$exists": False}
+                link_requests.append((aggr_msg_id, UpdateMany(
+                    link_filter,
                     {
                         "$set": {
-                            "aggregated_message_id": aggr_data["_id"]
+                            "aggregated_message_id": aggr_msg_id
                         }
-                    }, upsert=False)
-            mg_target_col.insert_one(to_insert)
+                    }, upsert=False)))
+        if lease is not None:
+            lease.check()
+        mg_target_col.insert_many(data.to_dicts("_id"), ordered=False)
+        # Tag the original messages with bulk requests, checking the lease
+        # before each of them, so that the tags are not written after
+        # another instance took the work unit over and reset it
+        linked_ids = set()
+        for requests in chunked(link_requests, LINK_REQUESTS_CHUNK_SIZE):
+            if lease is not None:
+                try:
+                    lease.check()
+                except LeaseLostError:
+                    # Nothing points to the messages which weren't linked yet
+                    mg_target_col.delete_many({"_id": {"$in": [x for x in data.ids.tolist()
+                                                               if x not in linked_ids]}})
+                    raise
+            mg_input_col.bulk_write([request for _, request in requests], ordered=False)
+            linked_ids.update(aggr_msg_id for aggr_msg_id, _ in requests)
+
+    def reset_work_unit(self, key, start, end):
+        """Delete the aggregated messages of the work unit and untag their originals
+
+        :param key: the key of the work unit
+        :param start: the start of the work unit time range
+        :param end: the end of the work unit time range
+        """
+        mg_input_col = self.mg[self.config.MG_INPUT_DB][self.config.MG_INPUT_COL]
+        mg_target_col = self.mg[self.config.MG_TARGET_DB][self.config.MG_TARGET_COL]
+        aggr_msg_ids = mg_target_col.distinct("_id", {"work_unit": key})
+        if not aggr_msg_ids:
+            return
+        _LOGGER.warning("Deleting %d aggregated messages of unfinished %s", len(aggr_msg_ids), key)
+        # The originals are untagged first, so that none of them points
+        # to a deleted message if the reset is interrupted
+        for ids in chunked(aggr_msg_ids):
+            mg_input_col.update_many(
+                {
+                    self.config.DATETIME_INDEX: {'$gte': start, '$lt': end},
+                    "aggregated_message_id": {"$in": ids}
+                },
+                {"$unset": {"aggregated_message_id": ""}})
+        mg_target_col.delete_many({"work_unit": key})
+
+
+class MongoDBLeaseStorage(LeaseStorage, MongoDBStorage):
+    """MongoDB lease storage implementation."""
+
+    NAME = "mg.lease"
+
+    def __init__(self, config):
+        """Initialize mongodb lease storage backend."""
+        LeaseStorage.__init__(self)
+        self.config = config
+        MongoDBStorage.__init__(self, config)
+        self.leases = self.mg[self.config.MG_TARGET_DB][LEASE_TABLE]
+
+    def _claim(self, key, owner, now, ttl):
+        try:
+            # If the lease exists but can't be taken, upsert fails on the duplicate _id
+            self.leases.update_one(
+                {
+                    "_id": key,
+                    "done": False,
+                    "$or": [{"expires_at": {"$lt": now}}, {"owner": owner}]
+                },
+                {
+                    "$set": {"owner": owner, "expires_at": now + ttl}
+                }, upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def _renew(self, key, owner, now, ttl):
+        result = self.leases.update_one({"_id": key, "owner": owner, "done": False},
+                                        {"$set": {"expires_at": now + ttl}})
+        return result.matched_count == 1
+
+    def _release(self, key, owner):
+        self.leases.update_one({"_id": key, "owner": owner, "done": False},
+                               {"$set": {"expires_at": 0}})
+
+    def _complete(self, key, owner):
+        result = self.leases.update_one({"_id": key, "owner": owner, "done": False},
+                                        {"$set": {"done": True}})
+        return result.matched_count == 1
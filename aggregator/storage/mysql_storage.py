@@ -1,10 +1,13 @@
 """MySQL storage interface"""
 import datetime
+import numpy as np
 import pandas
 import mysql.connector
 import logging
 import json
 from anomaly_detector.storage.storage import DataCleaner
+from aggregator.linkage import id_ranges, chunked, ranges_condition, ranges_update_sql
+from aggregator.storage.lease_storage import LeaseLostError, LeaseStorage, SQLLeaseStorage
 from anomaly_detector.storage.storage_source import StorageSource
 from anomaly_detector.storage.stdout_sink import StorageSink
 from anomaly_detector.storage.storage_attribute import MySQLStorageAttribute
@@ -56,39 +59,78 @@ class MySQLDataStorageSource(StorageSource, DataCleaner, MySQLStorage):
         self.config = config
         MySQLStorage.__init__(self, config)
 
-    def retrieve(self, storage_attribute: MySQLStorageAttribute):
-        """Retrieve data from MySQL"""
-        now = datetime.datetime.now()
+    def _pushdown_sql(self, sql):
+        """Wrap the select query so that exact duplicates are grouped by MySQL
+
+        Each resulting row represents one distinct message per hostname
+        with the number of its duplicates, their time and anomaly score
+        statistics and the logids of all the original messages.
+        Messages are compared byte by byte, not with the column collation
+        which ignores case and trailing spaces.
+        """
+        return ("SELECT MIN(logid), MIN(%s), FROM_UNIXTIME(AVG(UNIX_TIMESTAMP(%s))), MIN(%s), AVG(anomaly_score), "
+                "COUNT(*), GROUP_CONCAT(CAST(logid AS CHAR) ORDER BY logid), MIN(%s), MAX(%s) "
+                "FROM (%s) AS recent_logs GROUP BY BINARY %s, BINARY %s") % (
+            self.config.MESSAGE_INDEX,
+            self.config.DATETIME_INDEX,
+            self.config.HOSTNAME_INDEX,
+            self.config.DATETIME_INDEX,
+            self.config.DATETIME_INDEX,
+            sql,
+            self.config.MESSAGE_INDEX,
+            self.config.HOSTNAME_INDEX,
+        )
+
+    def retrieve(self, storage_attribute: MySQLStorageAttribute, pushdown=False, end=None,
+                 untagged_only=False):
+        """Retrieve data from MySQL
+
+        :param pushdown: group exact duplicates with GROUP BY in MySQL
+                         and return one weighted log per distinct message
+        :param end: the end of the time range, the current time by default
+        :param untagged_only: skip the logs which are already aggregated
+        """
+        now = end or datetime.datetime.now()
+        untagged_filter = " AND aggr_msg_id IS NULL" if untagged_only else ""
 
         cursor = self.db.cursor()
 
         if self.config.LOGSOURCE_HOSTNAME != 'localhost':
-            sql = "SELECT logid, %s, %s, %s, anomaly_score FROM %s WHERE (%s BETWEEN '%s' AND '%s' AND %s = '%s') ORDER BY %s DESC LIMIT %d" % (
+            sql = "SELECT logid, %s, %s, %s, anomaly_score FROM %s WHERE (%s >= '%s' AND %s < '%s' AND %s = '%s'%s) ORDER BY %s DESC LIMIT %d" % (
                 self.config.MESSAGE_INDEX,
                 self.config.DATETIME_INDEX,
                 self.config.HOSTNAME_INDEX,
                 self.config.MYSQL_INPUT_TABLE,
                 self.config.DATETIME_INDEX,
                 (now - datetime.timedelta(seconds=storage_attribute.time_range)).strftime("%Y-%m-%d %H:%M:%S"),
+                self.config.DATETIME_INDEX,
                 now.strftime("%Y-%m-%d %H:%M:%S"),
                 self.config.HOSTNAME_INDEX,
                 self.config.LOGSOURCE_HOSTNAME,
+                untagged_filter,
                 self.config.DATETIME_INDEX,
                 storage_attribute.number_of_entries
             )
         else:
-            sql = "SELECT logid, %s, %s, %s, anomaly_score FROM %s WHERE (%s BETWEEN '%s' AND '%s') ORDER BY %s DESC LIMIT %d" % (
+            sql = "SELECT logid, %s, %s, %s, anomaly_score FROM %s WHERE (%s >= '%s' AND %s < '%s'%s) ORDER BY %s DESC LIMIT %d" % (
                 self.config.MESSAGE_INDEX,
                 self.config.DATETIME_INDEX,
                 self.config.HOSTNAME_INDEX,
                 self.config.MYSQL_INPUT_TABLE,
                 self.config.DATETIME_INDEX,
                 (now - datetime.timedelta(seconds=storage_attribute.time_range)).strftime("%Y-%m-%d %H:%M:%S"),
+                self.config.DATETIME_INDEX,
                 now.strftime("%Y-%m-%d %H:%M:%S"),
+                untagged_filter,
                 self.config.DATETIME_INDEX,
                 storage_attribute.number_of_entries
             )
 
+        if pushdown:
+            sql = self._pushdown_sql(sql)
+            # The default limit of 1024 bytes would truncate the grouped logids
+            cursor.execute("SET SESSION group_concat_max_len = 4294967295")
+
         cursor.execute(sql)
         data = cursor.fetchall()
         json_data = []
@@ -99,14 +141,28 @@ class MySQLDataStorageSource(StorageSource, DataCleaner, MySQLStorage):
             tmp[self.config.DATETIME_INDEX] = x[2]
             tmp[self.config.HOSTNAME_INDEX] = x[3]
             tmp["anomaly_score"] = x[4]
+            if pushdown:
+                tmp["total_logs"] = x[5]
+                tmp["original_msgs_ids"] = [int(logid) for logid in x[6].split(",")]
+                tmp["min_datetime"] = x[7]
+                tmp["max_datetime"] = x[8]
             json_data.append(tmp)
 
-        _LOGGER.info(
-            "Reading %d log entries in last %d seconds from %s",
-            len(json_data),
-            storage_attribute.time_range,
-            self.config.MYSQL_INPUT_HOST,
-        )
+        if pushdown:
+            _LOGGER.info(
+                "Reading %d distinct log messages (%d log entries) in last %d seconds from %s",
+                len(json_data),
+                sum(x["total_logs"] for x in json_data),
+                storage_attribute.time_range,
+                self.config.MYSQL_INPUT_HOST,
+            )
+        else:
+            _LOGGER.info(
+                "Reading %d log entries in last %d seconds from %s",
+                len(json_data),
+                storage_attribute.time_range,
+                self.config.MYSQL_INPUT_HOST,
+            )
 
         if not len(json_data):
             return pandas.DataFrame(), json_data
@@ -122,6 +178,25 @@ class MySQLDataStorageSource(StorageSource, DataCleaner, MySQLStorage):
 
         return json_data_normalized, json_data
 
+    def get_hostnames(self, start, end, untagged_only=False):
+        """Return the hostnames which have logs within [start, end)
+
+        :param untagged_only: skip the logs which are already aggregated
+        """
+        cursor = self.db.cursor()
+        cursor.execute("SELECT DISTINCT %s FROM %s WHERE (%s >= '%s' AND %s < '%s'%s)" % (
+            self.config.HOSTNAME_INDEX,
+            self.config.MYSQL_INPUT_TABLE,
+            self.config.DATETIME_INDEX,
+            start.strftime("%Y-%m-%d %H:%M:%S"),
+            self.config.DATETIME_INDEX,
+            end.strftime("%Y-%m-%d %H:%M:%S"),
+            " AND aggr_msg_id IS NULL" if untagged_only else ""
+        ))
+        hostnames = [x[0] for x in cursor.fetchall() if x[0] is not None]
+        cursor.close()
+        return hostnames
+
 class MySQLDataSink(StorageSink, DataCleaner, MySQLStorage):
     """MySQL data sink implementation."""
 
@@ -145,30 +220,109 @@ class MySQLDataSink(StorageSink, DataCleaner, MySQLStorage):
             database=self.config.MYSQL_TARGET_DB
         )
 
-    def store_results(self, data, original_messages):
-        """Store results bach to MySQL"""
+    def store_results(self, data, original_messages, lease=None):
+        """Store results bach to MySQL
+
+        :param data: AggregatedBatch with the aggregated messages
+        :param lease: Lease of the work unit in distributed mode, the results
+                      are stored only while it belongs to this instance
+
+        The aggregated messages are committed before the original messages
+        are tagged, so a tag never points to a message which wasn't stored.
+        In distributed mode the aggregated messages carry the key of the
+        work unit (the target table needs work_unit column) and only
+        untagged messages are tagged: if tagging fails, the retry deletes
+        the messages of the work unit with reset_work_unit and starts over.
+        """
         input_cursor = self.input_db.cursor(buffered=True)
         target_cursor = self.target_db.cursor(buffered=True)
         _LOGGER.info("Inderting data to MySQL.")
-        for aggr_data in data:
-            to_insert = aggr_data.copy()
-            del to_insert["original_msgs_ids"]
-            to_insert["message"] = "'" + to_insert["message"].replace("'", "\\'") + "'"
-            to_insert["hostname"] = "'" + to_insert["hostname"] + "'"
-
-            insert_sql= "INSERT INTO " + self.config.MYSQL_TARGET_TABLE
-            insert_sql += " (" + ", ".join(map(str, list(to_insert.keys()))) + ") VALUES ("
-            insert_sql += ", ".join(map(str, list(to_insert.values()))) + ")"
-            target_cursor.execute(insert_sql)
-            self.target_db.commit()
 
-            update_sql = "UPDATE %s SET aggr_msg_id = %s WHERE logid in (%s)" % (
-                self.config.MYSQL_INPUT_TABLE,
-                aggr_data["aggr_msg_id"],
-                ", ".join(map(str, aggr_data["original_msgs_ids"]))
-            )
-            input_cursor.execute(update_sql)
+        # Lock the end of the id range until commit, so that concurrent
+        # aggregators don't allocate the same aggr_msg_ids
+        target_cursor.execute("SELECT MAX(aggr_msg_id) FROM %s FOR UPDATE" % self.config.MYSQL_TARGET_TABLE)
+        last_aggr_msg_id = target_cursor.fetchone()[0] or 0
+        data.ids = last_aggr_msg_id + np.arange(1, len(data) + 1, dtype=np.int64)
+
+        columns = ("aggr_msg_id",) + data.columns
+        insert_sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+            self.config.MYSQL_TARGET_TABLE,
+            ", ".join(columns),
+            ", ".join(["%s"] * len(columns))
+        )
+        target_cursor.executemany(insert_sql, data.rows())
+        if lease is not None:
+            try:
+                lease.check()
+            except LeaseLostError:
+                self.target_db.rollback()
+                raise
+        self.target_db.commit()
+
+        # Tag the original messages of the whole batch by ranges of consecutive
+        # logids, joining thousands of ranges in one statement
+        links = [(aggr_msg_id, first, last)
+                 for i, aggr_msg_id in enumerate(data.ids.tolist())
+                 for first, last in id_ranges(data.get_original_msgs_ids(i))]
+        for chunk in chunked(links):
+            input_cursor.execute(ranges_update_sql(self.config.MYSQL_INPUT_TABLE, "aggr_msg_id", chunk,
+                                                   untagged_only=lease is not None))
+        if lease is not None:
+            try:
+                lease.check()
+            except LeaseLostError:
+                # The new owner of the work unit deletes the stored messages
+                self.input_db.rollback()
+                raise
+        self.input_db.commit()
+
+        input_cursor.close()
+        target_cursor.close()
+
+    def reset_work_unit(self, key, start, end):
+        """Delete the aggregated messages of the work unit and untag their originals
+
+        :param key: the key of the work unit
+        :param start: the start of the work unit time range
+        :param end: the end of the work unit time range
+        """
+        input_cursor = self.input_db.cursor(buffered=True)
+        target_cursor = self.target_db.cursor(buffered=True)
+
+        target_cursor.execute("SELECT aggr_msg_id FROM %s WHERE work_unit = %%s" % self.config.MYSQL_TARGET_TABLE,
+                              (key,))
+        aggr_msg_ids = [x[0] for x in target_cursor.fetchall()]
+        if aggr_msg_ids:
+            _LOGGER.warning("Deleting %d aggregated messages of unfinished %s", len(aggr_msg_ids), key)
+            # The originals are untagged first, so that none of them points
+            # to a deleted message if the reset is interrupted
+            for ranges in chunked(id_ranges(aggr_msg_ids)):
+                input_cursor.execute("UPDATE %s SET aggr_msg_id = NULL WHERE %s >= '%s' AND %s < '%s' AND %s" % (
+                    self.config.MYSQL_INPUT_TABLE,
+                    self.config.DATETIME_INDEX,
+                    start.strftime("%Y-%m-%d %H:%M:%S"),
+                    self.config.DATETIME_INDEX,
+                    end.strftime("%Y-%m-%d %H:%M:%S"),
+                    ranges_condition("aggr_msg_id", ranges)
+                ))
             self.input_db.commit()
+            target_cursor.execute("DELETE FROM %s WHERE work_unit = %%s" % self.config.MYSQL_TARGET_TABLE,
+                                  (key,))
+            self.target_db.commit()
 
         input_cursor.close()
         target_cursor.close()
+
+
+class MySQLLeaseStorage(SQLLeaseStorage, MySQLStorage):
+    """MySQL lease storage implementation."""
+
+    NAME = "mysql.lease"
+
+    def __init__(self, config):
+        """Initialize MySQL lease storage backend."""
+        LeaseStorage.__init__(self)
+        self.config = config
+        MySQLStorage.__init__(self, config, is_input=False)
+        self.db.autocommit = True
+        self._create_table()
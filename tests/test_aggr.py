@@ -3,9 +3,17 @@ import pytest
 import datetime
 from pprint import pprint
 import calendar
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
 
 from aggregator.log_aggregator import Aggregator
+from aggregator.linkage import LINK_CHUNK_SIZE, id_ranges, ranges_condition, ranges_update_sql
+from aggregator.batch import AggregatedBatchBuilder
 from anomaly_detector.config import Configuration
+from aggregator.storage.mongodb_storage import MongoDBDataStorageSource
+from aggregator.storage.mysql_storage import MySQLDataStorageSource
 from anomaly_detector.storage.storage_attribute import MGStorageAttribute
 
 @pytest.fixture()
@@ -41,3 +49,151 @@ def test_mean_time(config):
     pprint(date_int_list)
     mean = aggr._get_mean_time(date_int_list)
     assert mean == date_list[4]
+
+
+def test_id_ranges():
+    """Test collapsing of original messages ids into ranges"""
+    assert id_ranges([7, 3, 4, 5, 9, 8, 12]) == [(3, 5), (7, 9), (12, 12)]
+    assert id_ranges([]) == []
+
+
+def test_ranges_condition():
+    """Test matching of id ranges in SQL"""
+    assert ranges_condition("aggr_msg_id", [(3, 5), (7, 7)]) == \
+        "(aggr_msg_id BETWEEN 3 AND 5 OR aggr_msg_id BETWEEN 7 AND 7)"
+
+
+def test_ranges_update_sql():
+    """Test tagging of the ranges of several aggregated messages in one statement"""
+    sql = ranges_update_sql("logs", "aggr_msg_id", [(11, 3, 5), (12, 7, 7)])
+    assert sql == ("UPDATE logs AS originals JOIN ("
+                   "SELECT 11 AS aggr_msg_id, 3 AS first_logid, 5 AS last_logid UNION ALL SELECT 12, 7, 7"
+                   ") AS links ON originals.logid BETWEEN links.first_logid AND links.last_logid "
+                   "SET originals.aggr_msg_id = links.aggr_msg_id")
+    sql = ranges_update_sql("logs", "aggr_msg_id", [(11, 3, 5)], untagged_only=True)
+    assert sql.endswith("SET originals.aggr_msg_id = links.aggr_msg_id WHERE originals.aggr_msg_id IS NULL")
+
+
+def test_weighted_mean_time(config):
+    """Test mean time of pre-aggregated logs"""
+    cfg, mgstor_attr = config
+    aggr = Aggregator(cfg)
+    base = datetime.datetime(2021, 12, 1, 12, 0, 0)
+    date_list = [base, base - datetime.timedelta(days=2)]
+    mean = aggr._get_mean_time(date_list, weights=[3, 1])
+    assert mean == base - datetime.timedelta(hours=12)
+
+
+def test_aggregated_batch():
+    """Test building of the columnar batch of aggregated messages"""
+    builder = AggregatedBatchBuilder()
+    mean_time = datetime.datetime(2021, 12, 1, 12, 0, 0)
+    builder.append("msg *** one", 3, mean_time, "host1", 0.5, [1, 2, 3])
+    builder.append("msg two", 1, mean_time, "host2", 0.25, [7])
+    batch = builder.build([11, 12])
+    assert len(batch) == 2
+    assert list(batch.get_original_msgs_ids(0)) == [1, 2, 3]
+    assert list(batch.get_original_msgs_ids(1)) == [7]
+    row = batch.rows()[1]
+    assert row[:6] == (12, "msg two", 1, mean_time, "host2", 0.25)
+    assert type(row[0]) is int
+    assert batch.to_dicts("aggr_msg_id")[0]["total_logs"] == 3
+    assert "work_unit" not in batch.to_dicts("aggr_msg_id")[0]
+    batch.work_unit = "web_logs:host1:2021-12-01T12:00:00-2021-12-01T13:00:00"
+    assert batch.columns[-1] == "work_unit"
+    assert batch.rows()[0][-1] == batch.work_unit
+    assert batch.to_dicts(None)[1]["work_unit"] == batch.work_unit
+
+
+def test_aggregate_weighted_logs(config):
+    """Test aggregation of logs pre-aggregated by the database"""
+    cfg, mgstor_attr = config
+    cfg.STORAGE_DATASOURCE = "mysql"
+    cfg.STORAGE_DATASINK = "mysql"
+    cfg.MESSAGE_INDEX = "message"
+    aggr = Aggregator(cfg, pushdown=True)
+    base = datetime.datetime(2021, 12, 1, 12, 0, 0)
+    logs_json = [{"logid": 1, "message": "user admin logged in", "timestamp": base,
+                  "hostname": "host1", "anomaly_score": 0.2,
+                  "total_logs": 3, "original_msgs_ids": [1, 2, 3]},
+                 {"logid": 10, "message": "user guest logged in", "timestamp": base - datetime.timedelta(hours=4),
+                  "hostname": "host2", "anomaly_score": 0.8,
+                  "total_logs": 1, "original_msgs_ids": [10]},
+                 {"logid": 20, "message": "disk is full", "timestamp": base,
+                  "hostname": "host2", "anomaly_score": 0.5,
+                  "total_logs": 2, "original_msgs_ids": [20, 21]}]
+    clusters = np.array([0, 0, -1])
+    df = pd.DataFrame({"message": [x["message"] for x in logs_json], "cluster": clusters})
+
+    batch = aggr.aggregate_logs(df, logs_json, clusters)
+
+    assert len(batch) == 2
+    # Noise log keeps all its duplicates
+    assert batch.messages[0] == "disk is full"
+    assert batch.total_logs[0] == 2
+    assert list(batch.get_original_msgs_ids(0)) == [20, 21]
+    # Cluster is weighted by the number of duplicates of each log
+    assert batch.messages[1] == "user *** logged in"
+    assert batch.total_logs[1] == 4
+    assert list(batch.get_original_msgs_ids(1)) == [1, 2, 3, 10]
+    assert batch.hostnames[1] == "host1"
+    assert batch.average_anomaly_scores[1] == pytest.approx(0.35)
+    assert batch.average_datetimes[1].tolist() == base - datetime.timedelta(hours=1)
+
+
+def test_mysql_pushdown_sql():
+    """Test grouping of exact duplicates in MySQL query"""
+    source = MySQLDataStorageSource.__new__(MySQLDataStorageSource)
+    source.config = SimpleNamespace(MESSAGE_INDEX="message", DATETIME_INDEX="timestamp",
+                                    HOSTNAME_INDEX="hostname")
+    sql = source._pushdown_sql("SELECT * FROM logs")
+    assert sql == ("SELECT MIN(logid), MIN(message), FROM_UNIXTIME(AVG(UNIX_TIMESTAMP(timestamp))), "
+                   "MIN(hostname), AVG(anomaly_score), COUNT(*), "
+                   "GROUP_CONCAT(CAST(logid AS CHAR) ORDER BY logid), MIN(timestamp), MAX(timestamp) "
+                   "FROM (SELECT * FROM logs) AS recent_logs GROUP BY BINARY message, BINARY hostname")
+
+
+def test_mongodb_pushdown_pipeline():
+    """Test grouping of exact duplicates in MongoDB aggregation pipeline"""
+    source = MongoDBDataStorageSource.__new__(MongoDBDataStorageSource)
+    source.config = SimpleNamespace(MESSAGE_INDEX="message", DATETIME_INDEX="timestamp",
+                                    HOSTNAME_INDEX="hostname")
+    query = {"timestamp": {"$gte": 0}}
+    match, sort, limit, group, unwind, chunk, project = source._pushdown_pipeline(
+        query, MGStorageAttribute(86400, 100))
+    assert match == {"$match": query}
+    assert sort == {"$sort": {"timestamp": -1}}
+    assert limit == {"$limit": 100}
+    assert group["$group"]["_id"] == {"message": "$message", "hostname": "$hostname"}
+    assert group["$group"]["original_msgs_ids"] == {"$push": "$_id"}
+    assert unwind["$unwind"]["includeArrayIndex"] == "id_index"
+    # The ids of one message are split into documents of LINK_CHUNK_SIZE ids
+    assert chunk["$group"]["_id"]["chunk"] == {"$floor": {"$divide": ["$id_index", LINK_CHUNK_SIZE]}}
+    assert chunk["$group"]["total_logs"] == {"$sum": 1}
+    assert chunk["$group"]["original_msgs_ids"] == {"$push": "$original_msgs_ids"}
+    assert project["$project"]["message"] == "$_id.message"
+    assert project["$project"]["hostname"] == "$_id.hostname"
+
+
+def test_aggregate_logs_to_stdout(config, capsys):
+    """Test printing of aggregated logs read from MySQL"""
+    cfg, mgstor_attr = config
+    cfg.STORAGE_DATASOURCE = "mysql"
+    cfg.STORAGE_DATASINK = "stdout"
+    cfg.MESSAGE_INDEX = "message"
+    aggr = Aggregator(cfg)
+    base = datetime.datetime(2021, 12, 1, 12, 0, 0)
+    logs_json = [{"logid": 1, "message": "link eth0 is down", "timestamp": base,
+                  "hostname": "host1", "anomaly_score": 0.5},
+                 {"logid": 2, "message": "link eth1 is down", "timestamp": base,
+                  "hostname": "host1", "anomaly_score": 0.5}]
+    clusters = np.array([0, 0])
+    df = pd.DataFrame({"message": [x["message"] for x in logs_json], "cluster": clusters})
+
+    batch = aggr.aggregate_logs(df, logs_json, clusters)
+    assert list(batch.get_original_msgs_ids(0)) == [1, 2]
+
+    aggr.sink_storage_catalog[cfg.STORAGE_DATASINK](batch, logs_json)
+    printed = capsys.readouterr().out
+    assert "link *** is down" in printed
+    assert "aggr_msg_id" not in printed and "_id" not in printed
@@ -0,0 +1,288 @@
+"""Test distributed aggregation with leases"""
+import datetime
+import multiprocessing
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from aggregator.distributed import DistributedAggregator, Lease, get_work_units
+from aggregator.storage.lease_storage import SQLiteLeaseStorage, LeaseLostError
+
+NOW = 1638360000 + 1800
+SLICE_LENGTH = 600
+NODES_NUMBER = 4
+
+
+def make_config(table):
+    """Return minimal configuration of one MySQL input table"""
+    return SimpleNamespace(STORAGE_DATASOURCE="mysql",
+                           MYSQL_INPUT_TABLE=table,
+                           LOGSOURCE_HOSTNAME="172.17.31.10",
+                           AGGR_TIME_SPAN=3600 * 6)
+
+
+class RecordingAggregator(DistributedAggregator):
+    """Record processed work units instead of aggregating logs"""
+
+    def __init__(self, results_path, *args, **kwargs):
+        DistributedAggregator.__init__(self, *args, **kwargs)
+        self.results_path = results_path
+
+    def process(self, config, unit, lease):
+        lease.check()
+        db = sqlite3.connect(self.results_path, timeout=30, isolation_level=None)
+        db.execute("INSERT INTO processed VALUES (?, ?)", (unit.key, self.node_id))
+        db.close()
+        time.sleep(0.01)
+
+
+def run_node(leases_path, results_path, node_id):
+    """Run one aggregator node in a separate process"""
+    configs = [make_config("web_logs"), make_config("utm_logs")]
+    aggr = RecordingAggregator(results_path, configs, SQLiteLeaseStorage(leases_path), node_id,
+                               slice_length=SLICE_LENGTH, slice_lag=0, lease_ttl=30)
+    aggr.run(now=NOW)
+
+
+@pytest.fixture()
+def paths(tmp_path):
+    """Create leases and results databases"""
+    leases_path = str(tmp_path / "leases.db")
+    results_path = str(tmp_path / "results.db")
+    db = sqlite3.connect(results_path)
+    db.execute("CREATE TABLE processed (lease_key TEXT, node_id TEXT)")
+    db.commit()
+    db.close()
+    return leases_path, results_path
+
+
+@pytest.fixture()
+def timezone(monkeypatch):
+    """Switch the local time zone of the process"""
+    def switch(name):
+        monkeypatch.setenv("TZ", name)
+        time.tzset()
+    yield switch
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_work_units():
+    """Test splitting of the time span into aligned finished slices"""
+    units = get_work_units(make_config("web_logs"), SLICE_LENGTH, now=NOW, timezone="utc")
+    assert len(units) == 36
+    assert units[0].end == datetime.datetime.utcfromtimestamp(NOW - NOW % SLICE_LENGTH)
+    assert all(x.start == y.end for x, y in zip(units, units[1:]))
+    assert all(x.time_range == SLICE_LENGTH for x in units)
+
+
+def test_work_units_lag():
+    """Test that the slices which ended less than slice_lag ago are left for later"""
+    units = get_work_units(make_config("web_logs"), SLICE_LENGTH, now=NOW + 60, slice_lag=300, timezone="utc")
+    assert units[0].end == datetime.datetime.utcfromtimestamp(NOW - SLICE_LENGTH)
+    units = get_work_units(make_config("web_logs"), SLICE_LENGTH, now=NOW + 300, slice_lag=300, timezone="utc")
+    assert units[0].end == datetime.datetime.utcfromtimestamp(NOW)
+
+
+def check_local_slices(units):
+    """Check that the local time windows are positive, adjacent and unique"""
+    assert len({x.key for x in units}) == len(units)
+    assert all(x.time_range > 0 for x in units)
+    assert all(x.start == y.end for x, y in zip(units, units[1:]))
+
+
+@pytest.mark.parametrize("slice_length", [900, 1800, 3600, 7200])
+def test_work_units_dst_end(timezone, slice_length):
+    """Test that the local windows don't overlap when the clock goes back"""
+    timezone("Europe/Berlin")
+    # 2021-10-31 03:00 CEST -> 02:00 CET
+    change = 1635642000
+    units = get_work_units(make_config("web_logs"), slice_length, now=change + 4 * 3600)
+    check_local_slices(units)
+    last_end = change + 4 * 3600
+    assert units[0].end == datetime.datetime.fromtimestamp(last_end - last_end % slice_length)
+    # The repeated hour is aggregated once
+    repeated = datetime.datetime(2021, 10, 31, 2, 30)
+    assert len([x for x in units if x.start <= repeated < x.end]) == 1
+
+
+def test_work_units_dst_start(timezone):
+    """Test that the local windows have no gap when the clock goes forward"""
+    timezone("Europe/Berlin")
+    # 2021-03-28 02:00 CET -> 03:00 CEST
+    change = 1616893200
+    units = get_work_units(make_config("web_logs"), 1800, now=change + 3 * 3600)
+    check_local_slices(units)
+    assert datetime.timedelta(seconds=3600 + 1800) in [x.end - x.start for x in units]
+
+
+def test_work_units_local_time(timezone):
+    """Test that MySQL slices are in local time and don't end in the future"""
+    timezone("America/New_York")
+    units = get_work_units(make_config("web_logs"), SLICE_LENGTH, now=NOW)
+    assert units[0].end == datetime.datetime.fromtimestamp(NOW - NOW % SLICE_LENGTH)
+    assert units[0].end <= datetime.datetime.fromtimestamp(NOW)
+    check_local_slices(units)
+
+
+def test_work_units_mongodb_utc(timezone):
+    """Test that MongoDB slices are always in UTC"""
+    timezone("Europe/Berlin")
+    config = SimpleNamespace(STORAGE_DATASOURCE="mg", MG_INPUT_COL="utm_anomaly",
+                             LOGSOURCE_HOSTNAME="172.17.31.10", AGGR_TIME_SPAN=3600 * 6)
+    units = get_work_units(config, SLICE_LENGTH, now=NOW)
+    assert units[0].end == datetime.datetime.utcfromtimestamp(NOW - NOW % SLICE_LENGTH)
+    assert all(x.time_range == SLICE_LENGTH for x in units)
+
+
+def test_work_units_hostnames():
+    """Test splitting of every slice into one work unit per hostname"""
+    config = make_config("web_logs")
+    config.LOGSOURCE_HOSTNAME = "localhost"
+    slices = []
+
+    def hostnames(start, end):
+        slices.append((start, end))
+        return ["host2", "host1"] if len(slices) % 2 else []
+
+    units = get_work_units(config, SLICE_LENGTH, now=NOW, timezone="utc", hostnames=hostnames)
+    assert len(slices) == 36
+    assert len(units) == 36
+    assert [x.hostname for x in units[:2]] == ["host1", "host2"]
+    assert units[0].start == units[1].start and units[0].key != units[1].key
+
+
+class HostsAggregator(RecordingAggregator):
+    """Record work units of the hosts which have logs in every other slice"""
+
+    def get_hostnames(self, config, start, end):
+        if config.LOGSOURCE_HOSTNAME != "localhost":
+            return DistributedAggregator.get_hostnames(self, config, start, end)
+        return ["host%d" % (start.hour % 3), "host3"]
+
+
+def test_run_splits_hostnames(paths):
+    """Test that every hostname of every slice is claimed and processed"""
+    leases_path, results_path = paths
+    config = make_config("web_logs")
+    config.LOGSOURCE_HOSTNAME = "localhost"
+    aggr = HostsAggregator(results_path, [config], SQLiteLeaseStorage(leases_path), "node1",
+                           slice_length=3600, slice_lag=0)
+    processed = aggr.run(now=NOW)
+    assert len(processed) == 12
+    assert {x.hostname for x in processed} == {"host0", "host1", "host2", "host3"}
+    # The units of all the hosts are done
+    assert aggr.run(now=NOW) == []
+
+
+def test_nodes_share_work(paths):
+    """Test that several processes process every work unit exactly once"""
+    leases_path, results_path = paths
+    processes = [multiprocessing.Process(target=run_node, args=(leases_path, results_path, "node%d" % i))
+                 for i in range(NODES_NUMBER)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    db = sqlite3.connect(results_path)
+    processed = [x[0] for x in db.execute("SELECT lease_key FROM processed")]
+    db.close()
+    expected = [x.key for table in ("web_logs", "utm_logs")
+                for x in get_work_units(make_config(table), SLICE_LENGTH, now=NOW)]
+    assert sorted(processed) == sorted(expected)
+
+
+def test_lease_takeover(tmp_path):
+    """Test that only expired leases are taken over and completed ones are never"""
+    storage = SQLiteLeaseStorage(str(tmp_path / "leases.db"))
+    assert storage.claim("unit", "node1", ttl=0.2)
+    assert not storage.claim("unit", "node2", ttl=0.2)
+    assert storage.renew("unit", "node1", ttl=0.2)
+    time.sleep(0.3)
+    assert storage.claim("unit", "node2", ttl=30)
+    assert not storage.renew("unit", "node1", ttl=30)
+    assert not storage.complete("unit", "node1")
+    assert storage.complete("unit", "node2")
+    assert not storage.claim("unit", "node2", ttl=30)
+
+
+class FlakyLeaseStorage(SQLiteLeaseStorage):
+    """Lease storage whose renewals fail for the given number of times"""
+
+    def __init__(self, path, failures):
+        SQLiteLeaseStorage.__init__(self, path)
+        self.failures = failures
+
+    def _renew(self, key, owner, now, ttl):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("connection lost")
+        return SQLiteLeaseStorage._renew(self, key, owner, now, ttl)
+
+
+def test_heartbeat_retries_renewal(tmp_path):
+    """Test that a failed renewal is retried while the lease is valid"""
+    storage = FlakyLeaseStorage(str(tmp_path / "leases.db"), failures=1)
+    assert storage.claim("unit", "node1", ttl=0.3)
+    with Lease(storage, "unit", "node1", ttl=0.3) as lease:
+        time.sleep(0.5)
+    assert not lease.lost.is_set()
+    lease.check()
+
+
+def test_heartbeat_loses_lease(tmp_path):
+    """Test that the lease is lost if it can't be renewed within ttl"""
+    storage = FlakyLeaseStorage(str(tmp_path / "leases.db"), failures=100)
+    assert storage.claim("unit", "node1", ttl=0.3)
+    with Lease(storage, "unit", "node1", ttl=0.3) as lease:
+        time.sleep(0.6)
+    assert lease.lost.is_set()
+    with pytest.raises(LeaseLostError):
+        lease.check()
+
+
+def test_lease_check_after_takeover(tmp_path):
+    """Test that results are not stored after the lease was taken over"""
+    storage = SQLiteLeaseStorage(str(tmp_path / "leases.db"))
+    assert storage.claim("unit", "node1", ttl=0.1)
+    lease = Lease(storage, "unit", "node1", ttl=0.1)
+    time.sleep(0.2)
+    assert storage.claim("unit", "node2", ttl=30)
+    with pytest.raises(LeaseLostError):
+        lease.check()
+
+
+def test_process_exhausts_work_unit(monkeypatch, tmp_path):
+    """Test that a work unit is aggregated until a pass reads less than AGGR_MAX_ENTRIES"""
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("anomaly_detector")
+    passes = [[60, 40], [100], [30], [10]]
+    resets = []
+
+    class PassAggregator:
+        def __init__(self, config, **kwargs):
+            assert config.LOGSOURCE_HOSTNAME == "host1"
+            self.kwargs = kwargs
+
+        def reset_work_unit(self):
+            resets.append(self.kwargs["lease"])
+
+        def aggregator(self):
+            return SimpleNamespace(total_logs=np.array(passes.pop(0)))
+
+    monkeypatch.setattr("aggregator.log_aggregator.Aggregator", PassAggregator)
+    config = make_config("web_logs")
+    config.LOGSOURCE_HOSTNAME = "localhost"
+    config.AGGR_MAX_ENTRIES = 100
+    aggr = DistributedAggregator([config], SQLiteLeaseStorage(str(tmp_path / "leases.db")), "node1",
+                                 slice_length=SLICE_LENGTH)
+    unit = get_work_units(config, SLICE_LENGTH, now=NOW, hostnames=lambda start, end: ["host1"])[0]
+    aggr.process(config, unit, lease="lease")
+    # The configuration of the other units is not changed
+    assert config.LOGSOURCE_HOSTNAME == "localhost"
+    assert resets == ["lease"]
+    assert passes == [[10]]
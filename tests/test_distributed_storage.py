@@ -0,0 +1,375 @@
+"""Test distributed aggregation through the real aggregator and storage sinks"""
+import copy
+import datetime
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip("numpy")
+for module in ("pandas", "sklearn", "gensim", "pymongo", "mysql.connector",
+               "anomaly_detector.storage.mongodb_storage"):
+    pytest.importorskip(module)
+
+from bson.objectid import ObjectId  # noqa: E402
+
+from aggregator.distributed import DistributedAggregator, Lease, get_work_units  # noqa: E402
+from aggregator.storage import mysql_storage  # noqa: E402
+from aggregator.storage.lease_storage import SQLiteLeaseStorage, LeaseLostError  # noqa: E402
+from aggregator.storage.mongodb_storage import MongoDBDataStorageSource, MongoDBDataSink  # noqa: E402
+from aggregator.storage.mysql_storage import MySQLDataStorageSource, MySQLDataSink  # noqa: E402
+
+NOW = 1638360000 + 60
+SLICE_LENGTH = 600
+HOSTNAMES = ["172.17.31.10", "172.17.31.11"]
+# Every work unit is aggregated in three passes: 10 + 10 + 5 logs
+LOGS_PER_UNIT = 25
+MAX_ENTRIES = 10
+
+
+def matches(doc, query):
+    """Return True if MongoDB document matches the query"""
+    for field, condition in query.items():
+        value = doc.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for operator, operand in condition.items():
+            if operator == "$exists" and (field in doc) != operand:
+                return False
+            if operator == "$in" and value not in operand:
+                return False
+            if operator == "$gte" and not (value is not None and value >= operand):
+                return False
+            if operator == "$lt" and not (value is not None and value < operand):
+                return False
+    return True
+
+
+class FakeCursor:
+    """Result of FakeCollection.find"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction):
+        self.docs = sorted(self.docs, key=lambda x: x[field], reverse=direction < 0)
+        return self
+
+    def limit(self, number):
+        self.docs = self.docs[:number]
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class FakeCollection:
+    """In-memory MongoDB collection which records the queries"""
+
+    def __init__(self):
+        self.docs = []
+        self.queries = []
+        self.hooks = {}
+
+    def _hook(self, name):
+        if name in self.hooks:
+            self.hooks[name]()
+
+    def find(self, query):
+        self.queries.append(query)
+        return FakeCursor([copy.deepcopy(x) for x in self.docs if matches(x, query)])
+
+    def distinct(self, field, query):
+        self.queries.append(query)
+        return list({x[field] for x in self.docs if matches(x, query)})
+
+    def count_documents(self, query):
+        return len([x for x in self.docs if matches(x, query)])
+
+    def insert_many(self, docs, ordered=True):
+        self.docs.extend(copy.deepcopy(docs))
+        self._hook("insert_many")
+
+    def update_many(self, query, update):
+        self.queries.append(query)
+        for doc in self.docs:
+            if matches(doc, query):
+                doc.update(update.get("$set", {}))
+                for field in update.get("$unset", {}):
+                    doc.pop(field, None)
+
+    def bulk_write(self, requests, ordered=True):
+        self._hook("bulk_write")
+        for request in requests:
+            self.update_many(request._filter, request._doc)
+
+    def delete_many(self, query):
+        self.docs = [x for x in self.docs if not matches(x, query)]
+
+
+class FakeMongoClient:
+    """In-memory MongoDB client shared by the sources and the sinks"""
+
+    def __init__(self):
+        self.dbs = {}
+
+    def __getitem__(self, name):
+        return self.dbs.setdefault(name, FakeDatabase())
+
+    def close(self):
+        pass
+
+
+class FakeDatabase(dict):
+    def __getitem__(self, name):
+        return self.setdefault(name, FakeCollection())
+
+
+def make_config(datasource):
+    """Return configuration of one input table of all the hosts"""
+    return SimpleNamespace(STORAGE_DATASOURCE=datasource, STORAGE_DATASINK=datasource,
+                           MG_HOST="localhost", MG_INPUT_DB="anomalydb", MG_INPUT_COL="utm_anomaly",
+                           MG_TARGET_DB="anomalydb", MG_TARGET_COL="utm_aggregated",
+                           MYSQL_INPUT_HOST="localhost", MYSQL_INPUT_PORT=3306, MYSQL_INPUT_USER="aggregator",
+                           MYSQL_INPUT_PASSWORD="password", MYSQL_INPUT_DB="logs", MYSQL_INPUT_TABLE="utm_anomaly",
+                           MYSQL_TARGET_HOST="localhost", MYSQL_TARGET_PORT=3306, MYSQL_TARGET_USER="aggregator",
+                           MYSQL_TARGET_PASSWORD="password", MYSQL_TARGET_DB="logs",
+                           MYSQL_TARGET_TABLE="utm_aggregated",
+                           MESSAGE_INDEX="message", DATETIME_INDEX="timestamp", HOSTNAME_INDEX="hostname",
+                           LOGSOURCE_HOSTNAME="localhost", AGGR_TIME_SPAN=2 * SLICE_LENGTH,
+                           AGGR_MAX_ENTRIES=MAX_ENTRIES, AGGR_VECTOR_LENGTH=10, AGGR_WINDOW=3,
+                           AGGR_EPS=0.5, AGGR_MIN_SAMPLES=2)
+
+
+@pytest.fixture()
+def mongo(monkeypatch):
+    """Replace MongoDB with the in-memory client filled with logs of two slices and hosts"""
+    client = FakeMongoClient()
+
+    def init(self, config):
+        self.config = config
+        self.mg = client
+
+    monkeypatch.setattr(MongoDBDataStorageSource, "__init__", init)
+    monkeypatch.setattr(MongoDBDataSink, "__init__", init)
+    slices_end = datetime.datetime.utcfromtimestamp(NOW - NOW % SLICE_LENGTH)
+    logs = client["anomalydb"]["utm_anomaly"]
+    for hostname, i in itertools.product(HOSTNAMES, range(2 * LOGS_PER_UNIT)):
+        logs.docs.append({"_id": ObjectId(),
+                          "message": "link eth%d is down on port %d" % (i % 3, i % 2),
+                          "timestamp": slices_end - datetime.timedelta(seconds=1 + i * SLICE_LENGTH // LOGS_PER_UNIT),
+                          "hostname": hostname,
+                          "anomaly_score": 0.5})
+    return client
+
+
+def run_node(lease_storage, node_id):
+    aggr = DistributedAggregator([make_config("mg")], lease_storage, node_id,
+                                 slice_length=SLICE_LENGTH, slice_lag=0, lease_ttl=30)
+    return aggr.run(now=NOW)
+
+
+def check_results(client, untagged=0):
+    """Check that every log is linked to exactly one stored aggregated message"""
+    logs = client["anomalydb"]["utm_anomaly"].docs
+    aggregated = {x["_id"]: x for x in client["anomalydb"]["utm_aggregated"].docs}
+    assert len([x for x in logs if "aggregated_message_id" not in x]) == untagged
+    counts = {}
+    for log in logs:
+        if "aggregated_message_id" in log:
+            counts[log["aggregated_message_id"]] = counts.get(log["aggregated_message_id"], 0) + 1
+    assert set(counts) <= set(aggregated) | {"old"}
+    for aggr_msg_id, message in aggregated.items():
+        assert counts.get(aggr_msg_id) == message["total_logs"]
+        assert message["work_unit"]
+
+
+def test_mongodb_work_units(mongo, tmp_path):
+    """Test that all the logs of all the hosts are aggregated in several passes"""
+    processed = run_node(SQLiteLeaseStorage(str(tmp_path / "leases.db")), "node1")
+    assert sorted((x.hostname, x.start) for x in processed) == sorted(
+        (hostname, x.start) for hostname in HOSTNAMES
+        for x in get_work_units(make_config("mg"), SLICE_LENGTH, now=NOW))
+    check_results(mongo)
+    # Only untagged logs are read and tagged
+    logs = mongo["anomalydb"]["utm_anomaly"]
+    reads = [x for x in logs.queries if "timestamp" in x and "_id" not in x]
+    assert reads and all(x["aggregated_message_id"] == {"$exists": False} for x in reads)
+    tags = [x for x in logs.queries if "_id" in x]
+    assert tags and all(x["aggregated_message_id"] == {"$exists": False} for x in tags)
+
+
+def test_mongodb_tagged_logs_skipped(mongo, tmp_path):
+    """Test that the logs which are already aggregated are not aggregated again"""
+    logs = mongo["anomalydb"]["utm_anomaly"].docs
+    for log in logs[::4]:
+        log["aggregated_message_id"] = "old"
+    run_node(SQLiteLeaseStorage(str(tmp_path / "leases.db")), "node1")
+    check_results(mongo)
+    assert len([x for x in logs if x["aggregated_message_id"] == "old"]) == len(logs[::4])
+
+
+def test_mongodb_retry_after_failed_tagging(mongo, tmp_path):
+    """Test that a work unit whose tagging failed is reset and aggregated again"""
+    bulk_writes = []
+
+    def fail_second_pass():
+        bulk_writes.append(True)
+        if len(bulk_writes) == 2:
+            raise RuntimeError("connection lost")
+
+    mongo["anomalydb"]["utm_anomaly"].hooks["bulk_write"] = fail_second_pass
+    storage = SQLiteLeaseStorage(str(tmp_path / "leases.db"))
+    assert len(run_node(storage, "node1")) == 2 * len(HOSTNAMES) - 1
+    # The first pass of the failed work unit is linked, the second one is only stored
+    assert len(run_node(storage, "node2")) == 1
+    check_results(mongo)
+
+
+def test_mongodb_takeover_during_write(mongo, tmp_path):
+    """Test that the work unit taken over in the middle of a write is aggregated once"""
+    storage = SQLiteLeaseStorage(str(tmp_path / "leases.db"))
+    taken_over = []
+
+    def take_over():
+        # node1 stalls after inserting the aggregated messages, its lease
+        # expires and node2 processes all the work units
+        del mongo["anomalydb"]["utm_aggregated"].hooks["insert_many"]
+        key = storage.db.execute("SELECT lease_key FROM aggregator_leases "
+                                 "WHERE owner = 'node1' AND done = 0").fetchone()[0]
+        storage.release(key, "node1")
+        taken_over.extend(run_node(storage, "node2"))
+
+    mongo["anomalydb"]["utm_aggregated"].hooks["insert_many"] = take_over
+    processed = run_node(storage, "node1")
+    assert processed == []
+    assert len(taken_over) == 2 * len(HOSTNAMES)
+    check_results(mongo)
+
+
+class FakeMySQLCursor:
+    """Cursor which records the statements and returns the prepared rows"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, sql, params=()):
+        self.connection.statements.append(sql)
+        self.rows = self.connection.results.pop(sql.split(" FROM ")[0], [])
+
+    def executemany(self, sql, rows):
+        self.connection.statements.append(sql)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def close(self):
+        pass
+
+
+class FakeMySQLConnection:
+    """Connection which records the statements and transactions"""
+
+    def __init__(self, statements, results):
+        self.statements = statements
+        self.results = results
+
+    def cursor(self, buffered=False):
+        return FakeMySQLCursor(self)
+
+    def commit(self):
+        self.statements.append("COMMIT")
+
+    def rollback(self):
+        self.statements.append("ROLLBACK")
+
+
+@pytest.fixture()
+def mysql(monkeypatch):
+    """Replace MySQL connections with the ones which record the statements"""
+    statements = []
+    base = datetime.datetime.fromtimestamp(NOW - NOW % SLICE_LENGTH - 60)
+    results = {
+        "SELECT logid, message, timestamp, hostname, anomaly_score": [
+            (i, "link eth%d is down on port %d" % (i % 3, i % 2), base, HOSTNAMES[0], 0.5)
+            for i in range(1, 8)],
+        "SELECT MAX(aggr_msg_id)": [(100,)],
+    }
+    monkeypatch.setattr(mysql_storage.mysql.connector, "connect",
+                        lambda **kwargs: FakeMySQLConnection(statements, results))
+    return statements
+
+
+def mysql_unit(storage, node_id="node1"):
+    config = make_config("mysql")
+    config.LOGSOURCE_HOSTNAME = HOSTNAMES[0]
+    unit = get_work_units(config, SLICE_LENGTH, now=NOW)[0]
+    assert storage.claim(unit.key, node_id, ttl=30)
+    return config, unit, Lease(storage, unit.key, node_id, ttl=30)
+
+
+def test_mysql_work_unit(mysql, tmp_path):
+    """Test that the real aggregator reads and tags only untagged MySQL logs"""
+    config, unit, lease = mysql_unit(SQLiteLeaseStorage(str(tmp_path / "leases.db")))
+    DistributedAggregator([config], None, "node1").process(config, unit, lease)
+    select = next(x for x in mysql if x.startswith("SELECT logid"))
+    assert "AND aggr_msg_id IS NULL" in select
+    insert = mysql.index(next(x for x in mysql if x.startswith("INSERT INTO utm_aggregated")))
+    assert "work_unit" in mysql[insert]
+    update = mysql.index(next(x for x in mysql if x.startswith("UPDATE utm_anomaly AS originals")))
+    assert mysql[update].endswith("WHERE originals.aggr_msg_id IS NULL")
+    # The aggregated messages are committed before the originals are tagged
+    assert insert < mysql.index("COMMIT", insert) < update < mysql.index("COMMIT", update)
+
+
+def test_mysql_takeover_before_write(mysql, tmp_path):
+    """Test that nothing is committed after the lease was taken over"""
+    storage = SQLiteLeaseStorage(str(tmp_path / "leases.db"))
+    config, unit, lease = mysql_unit(storage)
+    storage.release(unit.key, "node1")
+    assert storage.claim(unit.key, "node2", ttl=30)
+    aggr = DistributedAggregator([config], None, "node1")
+    with pytest.raises(LeaseLostError):
+        aggr.process(config, unit, lease)
+    assert "COMMIT" not in mysql
+    assert not [x for x in mysql if x.startswith("UPDATE")]
+
+
+def test_mysql_takeover_during_write(mysql, tmp_path, monkeypatch):
+    """Test that the tags are rolled back if the lease was lost while tagging"""
+    storage = SQLiteLeaseStorage(str(tmp_path / "leases.db"))
+    config, unit, lease = mysql_unit(storage)
+    checks = []
+
+    def check():
+        checks.append(True)
+        if len(checks) > 2:
+            raise LeaseLostError(unit.key)
+
+    monkeypatch.setattr(lease, "check", check)
+    with pytest.raises(LeaseLostError):
+        DistributedAggregator([config], None, "node1").process(config, unit, lease)
+    update = mysql.index(next(x for x in mysql if x.startswith("UPDATE utm_anomaly AS originals")))
+    assert mysql[update + 1:] == ["ROLLBACK"]
+
+
+def test_mysql_reset_work_unit(mysql, tmp_path):
+    """Test that the originals are untagged before the messages of the work unit are deleted"""
+    config, unit, lease = mysql_unit(SQLiteLeaseStorage(str(tmp_path / "leases.db")))
+    sink = MySQLDataSink(config)
+    sink.input_db.results["SELECT aggr_msg_id"] = [(5,), (6,), (9,)]
+    sink.reset_work_unit(unit.key, unit.start, unit.end)
+    _, untag, commit, delete, _ = mysql
+    assert untag.startswith("UPDATE utm_anomaly SET aggr_msg_id = NULL")
+    assert untag.endswith("(aggr_msg_id BETWEEN 5 AND 6 OR aggr_msg_id BETWEEN 9 AND 9)")
+    assert commit == "COMMIT"
+    assert delete.startswith("DELETE FROM utm_aggregated WHERE work_unit")
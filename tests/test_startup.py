@@ -0,0 +1,49 @@
+"""Test startup time of the aggregator"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which must not be loaded until a backend or a model is used
+HEAVY_MODULES = ["pandas", "sklearn", "gensim", "pymongo", "bson", "mysql.connector"]
+
+# Cumulative import time budget of the aggregator CLI in microseconds
+IMPORT_TIME_BUDGET = 1000000
+
+
+def import_times(module):
+    """Return cumulative import time of each module loaded by "import module"
+
+    The times are collected with "python -X importtime" in a clean interpreter
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                          cwd=REPO_DIR, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.fixture(scope="module")
+def aggregator_import_times():
+    """Import the aggregator CLI in a clean interpreter"""
+    for module in ("numpy", "click", "yaml", "anomaly_detector.config"):
+        pytest.importorskip(module)
+    return import_times("aggr_app")
+
+
+def test_no_heavy_imports(aggregator_import_times):
+    """Test that backends and ML libraries are not loaded at startup"""
+    for module in HEAVY_MODULES:
+        assert module not in aggregator_import_times
+
+
+def test_import_time(aggregator_import_times):
+    """Test that the aggregator CLI is imported within the time budget"""
+    assert aggregator_import_times["aggr_app"] < IMPORT_TIME_BUDGET